@@ -0,0 +1,118 @@
+import os
+import sys
+
+from fake_openai import FakeOpenAIServer
+    #python3 Benchmarks/check_api_errors.py
+
+# Checks the error paths of Scripts/util/api_client.py and select_cards.rate_card against the local fake
+# OpenAI server: a 400 is raised without being retried, a 400 for a JSON-schema reply switches card scoring
+# to free text, any other 400 is raised for that card and leaves structured scoring on, a 5xx is retried,
+# and a call that runs out of retries raises RetryBudgetExceeded.
+# Exits non-zero if any check fails.
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts")
+OBJECTIVE = "Describe the presentation of thiamine deficiency."
+CARD = "Wernicke encephalopathy is caused by a deficiency of {{c1::thiamine}}."
+
+
+def delta(server, before, key):
+    return server.snapshot()[key] - before[key]
+
+
+def check_bad_request_not_retried(server, api_client, openai):
+    server.reject_json_schema = True
+    before = server.snapshot()
+    try:
+        api_client.create_chat_completion(model="gpt-4o-mini", messages=[{"role": "user", "content": "hi"}],
+                                          response_format={"type": "json_schema", "json_schema": {"name": "x", "schema": {}}})
+    except openai.BadRequestError:
+        return delta(server, before, "requests") == 1, f"raised after {delta(server, before, 'requests')} request(s)"
+    return False, "no BadRequestError raised"
+
+
+def check_structured_fallback(server, select_cards):
+    server.reject_json_schema = True
+    select_cards._scoring["structured"] = True
+    before = server.snapshot()
+    gpt_reply, score = select_cards.rate_card(OBJECTIVE, CARD)
+    ok = isinstance(score, int) and not select_cards._scoring["structured"] and delta(server, before, "bad_requests") == 1
+    return ok, f"score {score}, structured scoring {'on' if select_cards._scoring['structured'] else 'off'}"
+
+
+def check_other_bad_request(server, select_cards, openai):
+    server.reject_json_schema = False
+    server.fail_next(1, status=400)
+    select_cards._scoring["structured"] = True
+    try:
+        select_cards.rate_card(OBJECTIVE, CARD)
+    except openai.BadRequestError as e:
+        ok = select_cards._scoring["structured"] and e.code == "context_length_exceeded"
+        return ok, f"{e.code} raised, structured scoring {'on' if select_cards._scoring['structured'] else 'off'}"
+    finally:
+        server.fail_next(0)
+    return False, "no BadRequestError raised"
+
+
+def check_server_error_retried(server, api_client):
+    server.reject_json_schema = False
+    server.fail_next(2)
+    before = server.snapshot()
+    response = api_client.create_embeddings(model="text-embedding-3-small", input=[CARD])
+    requests = delta(server, before, "requests")
+    return len(response.data) == 1 and requests == 3, f"2 500s, then success on request {requests}"
+
+
+def check_retry_budget(server, api_client, select_cards):
+    server.fail_next(api_client.MAX_RETRIES + 1)
+    select_cards._scoring["structured"] = True
+    before = server.snapshot()
+    try:
+        select_cards.rate_card(OBJECTIVE, CARD)
+    except api_client.RetryBudgetExceeded:
+        requests = delta(server, before, "requests")
+        return requests == api_client.MAX_RETRIES + 1, f"RetryBudgetExceeded after {requests} requests"
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+    finally:
+        server.fail_next(0)
+    return False, "no error raised"
+
+
+def main():
+    server = FakeOpenAIServer(0).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["ANKI_TAGGER_RESPONSE_CACHE"] = "off"
+    sys.path.insert(0, SCRIPTS_DIR)
+    import openai
+    import select_cards
+    from util import api_client
+    # short backoff and few retries keep the checks fast
+    api_client.MAX_RETRIES = 2
+    api_client.BACKOFF_CAP = 0.05
+
+    checks = [("400 raised without retrying", lambda: check_bad_request_not_retried(server, api_client, openai)),
+              ("400 for JSON schema falls back to free text", lambda: check_structured_fallback(server, select_cards)),
+              ("other 400 raised, structured scoring kept", lambda: check_other_bad_request(server, select_cards, openai)),
+              ("500 retried until it succeeds", lambda: check_server_error_retried(server, api_client)),
+              ("retries used up raise RetryBudgetExceeded", lambda: check_retry_budget(server, api_client, select_cards))]
+    failures = 0
+    try:
+        for name, check in checks:
+            # each check starts with a closed circuit breaker
+            api_client._breaker = api_client.CircuitBreaker()
+            try:
+                ok, detail = check()
+            except Exception as e:
+                ok, detail = False, f"{type(e).__name__}: {e}"
+            failures += not ok
+            print(f"{name:<46} {'ok' if ok else 'FAIL'}  {detail}")
+    finally:
+        server.stop()
+
+    if failures:
+        print(f"{failures} check(s) failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
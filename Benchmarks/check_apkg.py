@@ -0,0 +1,136 @@
+import io
+import os
+import sys
+import struct
+import shutil
+import sqlite3
+import zipfile
+import tempfile
+    #python3 Benchmarks/check_apkg.py
+
+# Checks that util.apkg.edit_collection rewrites an .apkg without damaging it: the collection is replaced,
+# and stored, deflated and data-descriptor members come out with the same bytes and compression. Runs once
+# with the raw copy and once with the public-API fallback. Exits non-zero if any check fails.
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts")
+COLLECTION = "collection.anki21"
+# zipfile only writes a data descriptor (flag bit 3) when the output can't be seeked back into
+DATA_DESCRIPTOR = 0x08
+# a zip local file header: signature, version, flags, method, time, date, CRC, sizes, name and extra lengths
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+
+class Unseekable(io.RawIOBase):
+    """A write-only file without seek/tell, like the pipe that makes zipfile write data descriptors."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.f.write(data)
+
+
+def make_apkg(folder):
+    """Write deck.apkg with a collection and one stored, one deflated and one data-descriptor member."""
+    db_path = os.path.join(folder, "source.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, guid TEXT, tags TEXT)")
+    conn.execute("INSERT INTO notes VALUES (1, 'g1', '')")
+    conn.commit()
+    conn.close()
+
+    apkg_path = os.path.join(folder, "deck.apkg")
+    with open(apkg_path, "wb") as f, zipfile.ZipFile(Unseekable(f), "w") as zf:
+        zf.write(db_path, COLLECTION, compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr("media", b'{"0": "image.jpg", "1": "sound.mp3"}', compress_type=zipfile.ZIP_STORED)
+        zf.writestr("0", os.urandom(200_000), compress_type=zipfile.ZIP_STORED)
+        zf.writestr("1", b"not very random " * 20_000, compress_type=zipfile.ZIP_DEFLATED)
+    return apkg_path
+
+
+def members(apkg_path):
+    with zipfile.ZipFile(apkg_path) as zf:
+        return {info.filename: (info.compress_type, zf.read(info)) for info in zf.infolist() if info.filename != COLLECTION}
+
+
+def headers_mismatched(apkg_path):
+    """
+    Members whose local header doesn't carry the CRC and sizes of the central directory. Strict readers
+    take them from the local header unless it points at a data descriptor, which a rewrite doesn't write.
+    """
+    mismatched = []
+    with zipfile.ZipFile(apkg_path) as zf, open(apkg_path, "rb") as f:
+        for info in zf.infolist():
+            f.seek(info.header_offset)
+            header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+            flags, crc, compress_size, file_size = header[2], header[6], header[7], header[8]
+            if flags & DATA_DESCRIPTOR or crc != info.CRC or (
+                    compress_size, file_size) not in ((info.compress_size, info.file_size), (0xFFFFFFFF, 0xFFFFFFFF)):
+                mismatched.append(info.filename)
+    return mismatched
+
+
+def check_rewrite(apkg, raw):
+    apkg.RAW_COPY = raw
+    folder = tempfile.mkdtemp(prefix="check_apkg_")
+    try:
+        apkg_path = make_apkg(folder)
+        with zipfile.ZipFile(apkg_path) as zf:
+            descriptors = sum(bool(info.flag_bits & DATA_DESCRIPTOR) for info in zf.infolist() if info.filename != COLLECTION)
+        if not descriptors:
+            return False, "the test deck has no data-descriptor members"
+        before = members(apkg_path)
+
+        with apkg.edit_collection(apkg_path) as db_path:
+            conn = sqlite3.connect(db_path)
+            conn.execute("UPDATE notes SET tags = ' L1::1_highly_relevant '")
+            conn.commit()
+            conn.close()
+
+        with zipfile.ZipFile(apkg_path) as zf:
+            bad = zf.testzip()
+        after = members(apkg_path)
+        with apkg.read_collection(apkg_path) as db_path:
+            conn = sqlite3.connect(db_path)
+            tags = conn.execute("SELECT tags FROM notes").fetchone()[0]
+            conn.close()
+        leftovers = [name for name in os.listdir(folder) if name.endswith(".tmp")]
+        mismatched = headers_mismatched(apkg_path)
+
+        ok = bad is None and after == before and not mismatched and tags.strip() == "L1::1_highly_relevant" and not leftovers
+        return ok, (f"{len(after)} members ({descriptors} with data descriptors) unchanged" if after == before
+                    else "members changed") + (f", CRC error in {bad}" if bad else "") + \
+            (f", local headers of {', '.join(mismatched)} disagree" if mismatched else "") + f", tags {tags.strip()!r}"
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main():
+    sys.path.insert(0, SCRIPTS_DIR)
+    from util import apkg
+    raw_copy = apkg.RAW_COPY
+
+    checks = [("rewrite copying members raw", lambda: check_rewrite(apkg, True)),
+              ("rewrite recompressing members", lambda: check_rewrite(apkg, False))]
+    if not raw_copy:
+        print("This Python's zipfile lacks what the raw copy needs; rewrites recompress every member")
+        checks = checks[1:]
+
+    failures = 0
+    for name, check in checks:
+        try:
+            ok, detail = check()
+        except Exception as e:
+            ok, detail = False, f"{type(e).__name__}: {e}"
+        failures += not ok
+        print(f"{name:<32} {'ok' if ok else 'FAIL'}  {detail}")
+
+    if failures:
+        print(f"{failures} check(s) failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
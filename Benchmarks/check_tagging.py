@@ -0,0 +1,44 @@
+import os
+import sys
+    #python3 Benchmarks/check_tagging.py
+
+# Checks tag_deck.merge_tags, which builds a note's tag string when the deck is tagged: a lecture's earlier
+# relevance tier is replaced (nested lecture tags too), other lectures' tags are kept, tags are deduplicated
+# case-insensitively, and tagging again changes nothing. Exits non-zero if any check fails.
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts")
+
+# (name, note tags, new tags, expected tags)
+CASES = [
+    ("new tier replaces the old one", " L1::2_somewhat_relevant ", ["L1::1_highly_relevant"],
+     ["L1::1_highly_relevant"]),
+    ("nested lecture tag's tier replaced", " M1::L1::2_somewhat_relevant ", ["M1::L1::1_highly_relevant"],
+     ["M1::L1::1_highly_relevant"]),
+    ("sibling lecture's tier kept", " M1::L2::2_somewhat_relevant ", ["M1::L1::1_highly_relevant"],
+     ["M1::L2::2_somewhat_relevant", "M1::L1::1_highly_relevant"]),
+    ("unrelated tags kept", " #AK_Step1 marked ", ["L1::3_minimally_relevant"],
+     ["#AK_Step1", "marked", "L1::3_minimally_relevant"]),
+    ("duplicates dropped case-insensitively", " Marked marked ", ["L1::1_highly_relevant"],
+     ["Marked", "L1::1_highly_relevant"]),
+    ("tagging again changes nothing", " M1::L1::1_highly_relevant ", ["M1::L1::1_highly_relevant"],
+     ["M1::L1::1_highly_relevant"]),
+]
+
+
+def main():
+    sys.path.insert(0, SCRIPTS_DIR)
+    from tag_deck import merge_tags
+
+    failures = 0
+    for name, note_tags, new_tags, expected in CASES:
+        merged = merge_tags(note_tags, new_tags)
+        ok = merged.split() == expected
+        failures += not ok
+        print(f"{name:<40} {'ok' if ok else 'FAIL'}  {merged.strip()!r}")
+
+    if failures:
+        print(f"{failures} check(s) failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+    #python3 Benchmarks/fake_openai.py --port 8765 --latency-ms 50 --rate-limit-every 20
+    #OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake python3 main.py
+
+# A local stand-in for the OpenAI embeddings and chat completions endpoints. Replies are deterministic
+# (the same text always gets the same embedding and the same objective/card pair the same score), with
+# configurable latency, injected 429s, 500s and context-length 400s, optionally a 400 for JSON-schema replies
+# (like a model without structured outputs), and a running count of requests and tokens at GET /stats.
+
+DEFAULT_DIM = 256
+CHARS_PER_TOKEN = 4
+
+
+def text_seed(text):
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+
+
+def fake_embedding(text, dim=DEFAULT_DIM):
+    """Unit vector determined by text alone, so fixtures can be built without the server."""
+    vector = np.random.default_rng(text_seed(text)).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def fake_score(obj, card):
+    # skewed towards low scores, like real ratings, so the poor-match stop rule gets exercised
+    return int(100 * (text_seed(obj + "\x00" + card) % 10000 / 10000) ** 1.5)
+
+
+def count_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def objectives_reply(prompt):
+    # the objective prompt marks pages [Page n] and wants each page's objectives numbered from 1
+    pages = re.findall(r"\[Page (\d+)\]\n(.*?)(?=\n\n\[Page |\"\n\n)", prompt, flags=re.DOTALL) or [("1", prompt)]
+    lines = []
+    for page, text in pages:
+        words = re.findall(r"[A-Za-z]{4,}", text) or ["material"]
+        rng = random.Random(text_seed(text))
+        lines.append(f"[Page {page}]")
+        for n in range(1, 4):
+            lines.append(f"{n}. Describe how {' '.join(rng.sample(words, min(3, len(words))))} relates to page {page} topic {n}.")
+    return "\n".join(lines)
+
+
+def chat_reply(body):
+    prompt = body["messages"][-1]["content"]
+    reply_format = (body.get("response_format") or {}).get("type")
+    obj = re.search(r"Learning question: (.*)", prompt)
+    obj = obj.group(1).strip() if obj else ""
+
+    if reply_format == "json_object":
+        cards = re.findall(r"Anki card (\S+): (.*)", prompt)
+        return json.dumps({guid: fake_score(obj, card.strip()) for guid, card in cards})
+    card = re.search(r"Anki card: (.*)", prompt)
+    if card:
+        score = fake_score(obj, card.group(1).strip())
+        if reply_format == "json_schema":
+            return json.dumps({"score": score, "reason": "Deterministic benchmark score."})
+        return f"Score: {score} Deterministic benchmark score."
+    return objectives_reply(prompt)
+
+
+class FakeOpenAIServer:
+
+    def __init__(self, port=0, latency_ms=0, jitter_ms=0, rate_limit_every=0, retry_after_ms=100, dim=DEFAULT_DIM,
+                 server_error_every=0, reject_json_schema=False):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_ms = retry_after_ms
+        self.dim = dim
+        self.server_error_every = server_error_every
+        self.reject_json_schema = reject_json_schema
+        self.failures_left = 0
+        self.failure_status = 500
+        self.stats = {"requests": 0, "embedding_requests": 0, "chat_requests": 0, "rate_limited": 0,
+                      "server_errors": 0, "bad_requests": 0,
+                      "embedded_texts": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def _count(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def fail_next(self, count, status=500):
+        """Answer the next count requests with a 500, or with a 400 for a prompt over the context length."""
+        with self._lock:
+            self.failures_left = count
+            self.failure_status = status
+
+    def _injected_error(self):
+        """429, 500 or 400 if this request is one to fail, else None."""
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.failures_left:
+                self.failures_left -= 1
+                self.stats["server_errors" if self.failure_status == 500 else "bad_requests"] += 1
+                return self.failure_status
+            if self.rate_limit_every and self.stats["requests"] % self.rate_limit_every == 0:
+                self.stats["rate_limited"] += 1
+                return 429
+            if self.server_error_every and self.stats["requests"] % self.server_error_every == 0:
+                self.stats["server_errors"] += 1
+                return 500
+            return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, payload, headers=()):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers:
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/stats"):
+                    self._send(200, server.snapshot())
+                else:
+                    self._send(404, {"error": {"message": "not found"}})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                time.sleep((server.latency_ms + random.uniform(0, server.jitter_ms)) / 1000)
+                error = server._injected_error()
+                if error == 500:
+                    self._send(500, {"error": {"message": "Internal server error (injected)", "type": "server_error"}})
+                elif error == 400:
+                    self._send(400, {"error": {"message": "This model's maximum context length was exceeded (injected)",
+                                               "type": "invalid_request_error", "param": "messages",
+                                               "code": "context_length_exceeded"}})
+                elif error == 429:
+                    self._send(429, {"error": {"message": "Rate limit reached (injected)", "type": "requests",
+                                               "code": "rate_limit_exceeded"}},
+                               [("retry-after-ms", str(server.retry_after_ms)),
+                                ("retry-after", str(max(1, round(server.retry_after_ms / 1000))))])
+                elif self.path.endswith("/embeddings"):
+                    self._embeddings(body)
+                elif self.path.endswith("/chat/completions"):
+                    self._chat(body)
+                else:
+                    self._send(404, {"error": {"message": f"no fake for {self.path}"}})
+
+            def _embeddings(self, body):
+                texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+                tokens = sum(count_tokens(text) for text in texts)
+                server._count(embedding_requests=1, embedded_texts=len(texts), prompt_tokens=tokens)
+                self._send(200, {"object": "list", "model": body.get("model", ""),
+                                 "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text, server.dim).tolist()}
+                                          for i, text in enumerate(texts)],
+                                 "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+            def _chat(self, body):
+                if server.reject_json_schema and (body.get("response_format") or {}).get("type") == "json_schema":
+                    server._count(bad_requests=1)
+                    self._send(400, {"error": {"message": "Invalid parameter: 'response_format' of type 'json_schema' is "
+                                                          "not supported with this model.", "type": "invalid_request_error",
+                                               "param": "response_format", "code": None}})
+                    return
+                content = chat_reply(body)
+                prompt_tokens = sum(count_tokens(m["content"]) for m in body["messages"])
+                completion_tokens = count_tokens(content)
+                server._count(chat_requests=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+                self._send(200, {"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                                 "model": body.get("model", ""),
+                                 "choices": [{"index": 0, "finish_reason": "stop",
+                                              "message": {"role": "assistant", "content": content}}],
+                                 "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                           "total_tokens": prompt_tokens + completion_tokens}})
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve deterministic fake OpenAI embeddings and chat completions.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0, help="Delay added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Extra random delay of up to this much")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth request with a 429 (0 = never)")
+    parser.add_argument("--retry-after-ms", type=int, default=100, help="Retry-After sent with injected 429s")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM, help="Embedding dimensions")
+    parser.add_argument("--server-error-every", type=int, default=0, help="Answer every Nth request with a 500 (0 = never)")
+    parser.add_argument("--reject-json-schema", action="store_true",
+                        help="Answer JSON-schema chat requests with a 400, like a model without structured outputs")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.port, args.latency_ms, args.jitter_ms, args.rate_limit_every,
+                              args.retry_after_ms, args.dim, args.server_error_every, args.reject_json_schema)
+    print(f"Fake OpenAI API at {server.base_url} (stats at {server.base_url}/stats). Ctrl-C to stop.")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.snapshot(), indent=1))
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
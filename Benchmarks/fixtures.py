@@ -0,0 +1,67 @@
+import os
+import sys
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from fake_openai import fake_embedding, count_tokens, DEFAULT_DIM
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts"))
+from util.embedding_store import save_store
+from util.lecture_text import write_pages
+
+# Synthetic decks and lectures for the benchmarks: size -> (cards in the deck, pages in the lecture)
+SIZES = {"1k": (1000, 10), "10k": (10000, 30), "100k": (100000, 100)}
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+WORDS_PER_PAGE = 150
+VOCABULARY = ("thiamine deficiency beriberi wernicke korsakoff niacin pellagra dermatitis diarrhea dementia "
+              "cobalamin megaloblastic anemia folate homocysteine methylmalonic neuropathy vitamin retinol "
+              "night blindness xerophthalmia calciferol rickets osteomalacia tocopherol hemolysis phylloquinone "
+              "coagulation prothrombin scurvy collagen ascorbate gingival bleeding biotin avidin riboflavin "
+              "cheilosis pyridoxine isoniazid sideroblastic pantothenic acetyl zinc dysgeusia acrodermatitis "
+              "copper ceruloplasmin menkes wilson iron ferritin transferrin hepcidin hemochromatosis insulin "
+              "glucagon glycogen gluconeogenesis ketone lipolysis cortisol aldosterone renin angiotensin "
+              "sodium potassium acidosis alkalosis bicarbonate chloride").split()
+
+
+def fixture_paths(size, dim=DEFAULT_DIM, folder=FIXTURE_DIR):
+    base = os.path.join(folder, f"{size}_d{dim}")
+    return {"deck": os.path.join(base, "deck_embeddings.csv"),
+            "notes": os.path.join(base, "deck_notes.sqlite"),
+            "lecture": os.path.join(base, f"lecture_{size}_text.jsonl")}
+
+
+def make_text(rng, n_words):
+    return " ".join(rng.choice(VOCABULARY, n_words))
+
+
+def make_fixture(size, dim=DEFAULT_DIM, folder=FIXTURE_DIR):
+    """Build (once) the deck store, its notes table and a lecture for size; returns their paths."""
+    paths = fixture_paths(size, dim, folder)
+    if all(os.path.exists(path) for path in paths.values()):
+        return paths
+    n_cards, n_pages = SIZES[size]
+    os.makedirs(os.path.dirname(paths["deck"]), exist_ok=True)
+    rng = np.random.default_rng(0)
+
+    cards = [f"{make_text(rng, int(rng.integers(12, 40)))} (card {i})" for i in range(n_cards)]
+    guids = [f"g{i:07d}" for i in range(n_cards)]
+    deck = pd.DataFrame({"guid": guids, "card": cards, "tokens": [count_tokens(card) for card in cards],
+                         "mod": np.ones(n_cards, dtype=np.int64)})
+    # the same vectors the fake server would return, so the deck needs no embedding run
+    save_store(deck, np.vstack([fake_embedding(card, dim) for card in cards]), paths["deck"])
+
+    if os.path.exists(paths["notes"]):
+        os.remove(paths["notes"])
+    conn = sqlite3.connect(paths["notes"])
+    conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, guid TEXT, mod INTEGER, usn INTEGER, tags TEXT, flds TEXT)")
+    conn.executemany("INSERT INTO notes VALUES (?, ?, 1, 0, '', ?)", [(i + 1, g, c) for i, (g, c) in enumerate(zip(guids, cards))])
+    conn.commit()
+    conn.close()
+
+    with open(paths["lecture"], "w", encoding="utf-8") as f:
+        write_pages(f, "lecture.pdf", [make_text(rng, WORDS_PER_PAGE) for _ in range(n_pages)])
+
+    print(f"Built {size} fixture: {n_cards} cards, {n_pages} lecture pages in {os.path.dirname(paths['deck'])}")
+    return paths
@@ -0,0 +1,92 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+    #python3 Benchmarks/import_time.py
+    #python3 Benchmarks/import_time.py --scale 2   (slower machine)
+    #python3 Benchmarks/import_time.py --skip-missing   (without every optional dependency installed)
+
+# Import-time budgets for the modules every pipeline stage loads. Exits non-zero if one is over budget, fails
+# to import, or drags in the plotting/analysis stack that only util.embeddings_analysis needs.
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts")
+BUDGET_SECONDS = {
+    "util.embeddings_utils": 1.5,
+    "util.embedding_store": 1.0,
+    "select_cards": 2.5,
+    "embed_anki_deck": 2.5,
+    "make_learning_objectives": 3.0,
+}
+HEAVY_MODULES = ("matplotlib", "plotly", "sklearn", "scipy")
+RUNS = 3
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+MISSING_MODULE_LINE = re.compile(r"ModuleNotFoundError: No module named '([^']+)'")
+
+
+def missing_dependency(module, error):
+    """The third-party package module failed to import for lack of, or None if it failed for another reason."""
+    match = MISSING_MODULE_LINE.search(error)
+    if match is None:
+        return None
+    package = match.group(1).split(".")[0]
+    # a missing module of this repo is a bug, not an optional dependency
+    if package == module.split(".")[0] or os.path.exists(os.path.join(SCRIPTS_DIR, package + ".py")) \
+            or os.path.isdir(os.path.join(SCRIPTS_DIR, package)):
+        return None
+    return package
+
+
+def measure(module):
+    """
+    Return (best cumulative import seconds over RUNS fresh interpreters, heavy modules loaded, None),
+    or (None, None, the interpreter's error output) if the import fails.
+    """
+    env = dict(os.environ)
+    best, heavy = None, set()
+    for _ in range(RUNS):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=SCRIPTS_DIR, env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None, None, result.stderr
+        for match in IMPORT_TIME_LINE.finditer(result.stderr):
+            name = match.group(4)
+            if name.split(".")[0] in HEAVY_MODULES:
+                heavy.add(name.split(".")[0])
+            if name == module and match.group(3) == " ":
+                seconds = int(match.group(2)) / 1e6
+                best = seconds if best is None else min(best, seconds)
+    return best, heavy, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the pipeline modules against a budget.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every budget, eg. for a slow machine")
+    parser.add_argument("--skip-missing", action="store_true",
+                        help="Skip, rather than fail, modules whose third-party dependencies are not installed")
+    parser.add_argument("modules", nargs="*", default=list(BUDGET_SECONDS), help="Modules to check (default all)")
+    args = parser.parse_args()
+
+    failures = 0
+    for module in args.modules:
+        seconds, heavy, error = measure(module)
+        if error is not None:
+            dependency = missing_dependency(module, error)
+            if dependency and args.skip_missing:
+                print(f"{module:<28} skipped, {dependency} is not installed")
+                continue
+            failures += 1
+            print(f"{module:<28} import failed  FAIL\n  {error.strip().splitlines()[-1]}")
+            continue
+        budget = BUDGET_SECONDS.get(module, max(BUDGET_SECONDS.values())) * args.scale
+        status = "ok" if seconds <= budget and not heavy else "FAIL"
+        failures += status == "FAIL"
+        extra = f"  loads {', '.join(sorted(heavy))}" if heavy else ""
+        print(f"{module:<28} {seconds:6.2f}s  budget {budget:5.2f}s  {status}{extra}")
+
+    if failures:
+        print(f"{failures} module(s) over budget or failing to import")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
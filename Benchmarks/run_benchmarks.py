@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from fake_openai import FakeOpenAIServer, DEFAULT_DIM
+from fixtures import SIZES, make_fixture
+    #python3 Benchmarks/run_benchmarks.py
+    #python3 Benchmarks/run_benchmarks.py --sizes 1k 10k 100k --latency-ms 80 --jitter-ms 40 --rate-limit-every 50
+    #python3 Benchmarks/run_benchmarks.py --save-baseline   (after a change that is meant to be faster or slower, or on a new machine)
+
+# Runs the pipeline stages against a local fake OpenAI server on synthetic decks and lectures, so throughput
+# can be measured without spending anything. Reports each stage's wall time, items/sec and client-side
+# request latency percentiles, and exits non-zero if a stage is slower than the committed baseline allows, or
+# if there is no baseline to compare against (run --save-baseline to record one for the defaults used here).
+# tiktoken's encoding files must already be cached (run any script once online), the rest is offline.
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+STAGES = ("embed", "objectives", "selection", "tag")
+PERCENTILES = (50, 95, 99)
+DEFAULT_TOLERANCE = 0.25
+STATS_SHOWN = ("requests", "rate_limited", "prompt_tokens", "completion_tokens")
+
+latencies = {"embeddings": [], "chat": []}
+
+
+def time_requests(cls, kind):
+    """Record the client-side latency of every call to cls.create, retries included."""
+    create = cls.create
+
+    def timed_create(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return create(self, *args, **kwargs)
+        finally:
+            latencies[kind].append(time.perf_counter() - start)
+
+    cls.create = timed_create
+
+
+def latency_summary():
+    summary = {}
+    for kind, values in latencies.items():
+        if values:
+            summary[kind] = {f"p{p}": round(float(np.percentile(values, p)) * 1000, 1) for p in PERCENTILES}
+            summary[kind]["n"] = len(values)
+    return summary
+
+
+class SqliteCollection:
+    """Just enough of anki's Collection (col.db.all / executemany) for tag_deck.apply_tags on a plain notes table."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.db = self
+
+    def all(self, sql, *args):
+        return self.conn.execute(sql, args).fetchall()
+
+    def executemany(self, sql, rows):
+        self.conn.executemany(sql, rows)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def stage_embed(paths, workdir):
+    from embed_anki_deck import calculate_embeddings_batched
+    df = pd.read_csv(paths["deck"], usecols=["guid", "card", "tokens"])
+    calculate_embeddings_batched(df)
+    return len(df)
+
+
+def stage_objectives(paths, workdir):
+    import make_learning_objectives
+    lecture = shutil.copy(paths["lecture"], workdir)
+    make_learning_objectives.main(lecture)
+    return len(pd.read_csv(workdir_objectives(lecture)))
+
+
+def workdir_objectives(lecture):
+    from util.lecture_text import lecture_name
+    return lecture_name(lecture) + "_learning_objectives.csv"
+
+
+def stage_selection(paths, workdir):
+    import select_cards
+    from util.results_store import ResultsStore
+    obj_path = workdir_objectives(paths["lecture"])
+    select_cards.main(paths["deck"], obj_path)
+    store = ResultsStore()
+    try:
+        return store.count([select_cards.lecture_prefix(obj_path)])
+    finally:
+        store.close()
+
+
+def stage_tag(paths, workdir):
+    try:
+        from tag_deck import apply_tags, load_best_scores
+    except ImportError as e:
+        print(f"Skipping the tag stage: {e}")
+        return None
+    from select_cards import lecture_prefix
+    from util.results_store import DEFAULT_RESULTS_PATH
+    df = load_best_scores(DEFAULT_RESULTS_PATH, [lecture_prefix(workdir_objectives(paths["lecture"]))])
+    col = SqliteCollection(shutil.copy(paths["notes"], workdir))
+    try:
+        apply_tags(col, df)
+    finally:
+        col.close()
+    return len(df)
+
+
+STAGE_FUNCTIONS = {"embed": stage_embed, "objectives": stage_objectives, "selection": stage_selection, "tag": stage_tag}
+
+
+def run_size(size, server, stages, dim):
+    paths = make_fixture(size, dim)
+    workdir = tempfile.mkdtemp(prefix=f"anki_tagger_bench_{size}_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    results = {}
+    try:
+        for stage in stages:
+            for values in latencies.values():
+                values.clear()
+            before = server.snapshot()
+            start = time.perf_counter()
+            items = STAGE_FUNCTIONS[stage](paths, workdir)
+            elapsed = time.perf_counter() - start
+            if items is None:
+                continue
+            after = server.snapshot()
+            results[stage] = {"items": items, "seconds": round(elapsed, 3),
+                              "items_per_sec": round(items / max(elapsed, 1e-9), 2),
+                              "latency_ms": latency_summary(),
+                              "server": {key: after[key] - before[key] for key in STATS_SHOWN}}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_results(size, results):
+    print(f"\n{size}:")
+    print(f"  {'stage':<11}{'items':>8}{'seconds':>9}{'items/s':>10}  {'latency p50/p95/p99 ms':<44}server")
+    for stage, result in results.items():
+        latency = "  ".join(f"{kind} {l['p50']}/{l['p95']}/{l['p99']}" for kind, l in result["latency_ms"].items()) or "-"
+        server = ", ".join(f"{key} {value}" for key, value in result["server"].items() if value)
+        print(f"  {stage:<11}{result['items']:>8}{result['seconds']:>9.2f}{result['items_per_sec']:>10.1f}  {latency:<44}{server}")
+
+
+def check_regressions(report, baseline, tolerance):
+    """
+    Return (stages whose throughput fell more than tolerance below the baseline, stages compared).
+    Nothing is compared if the baseline was recorded with another fake-server config.
+    """
+    if baseline["config"] != report["config"]:
+        print(f"Baseline was recorded with {baseline['config']}, not {report['config']}")
+        return [], 0
+    failures = []
+    compared = 0
+    for size, results in report["results"].items():
+        for stage, result in results.items():
+            expected = baseline["results"].get(size, {}).get(stage)
+            if expected is None:
+                print(f"No baseline for {size} {stage}")
+                continue
+            compared += 1
+            floor = expected["items_per_sec"] * (1 - tolerance)
+            if result["items_per_sec"] < floor:
+                failures.append(f"{size} {stage}: {result['items_per_sec']:.1f} items/s, baseline "
+                                f"{expected['items_per_sec']:.1f} (floor {floor:.1f})")
+    return failures, compared
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages against a local fake OpenAI server.")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["1k", "10k"])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES),
+                        help="selection needs objectives, and tag needs selection, in the same run")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Fake server delay per request")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="Extra random delay of up to this much")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth request with a 429 (0 = never)")
+    parser.add_argument("--retry-after-ms", type=int, default=100, help="Retry-After sent with injected 429s")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM, help="Embedding dimensions")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Throughput baseline to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Write this run's results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed throughput drop (0.25 = 25%%)")
+    parser.add_argument("--output", default=None, help="Also write the full report as JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = FakeOpenAIServer(0, args.latency_ms, args.jitter_ms, args.rate_limit_every, args.retry_after_ms, args.dim).start()
+
+    # the OpenAI clients read these when they are first built, so they are set before any Scripts import;
+    # both caches would otherwise turn every run after the first into a cache benchmark
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["ANKI_TAGGER_RESPONSE_CACHE"] = "off"
+    cache_dir = tempfile.mkdtemp(prefix="anki_tagger_bench_cache_")
+    os.environ["ANKI_TAGGER_EMBEDDING_CACHE"] = os.path.join(cache_dir, "embedding_cache.sqlite")
+    sys.path.insert(0, SCRIPTS_DIR)
+    from openai.resources.chat.completions import Completions
+    from openai.resources.embeddings import Embeddings
+    time_requests(Completions, "chat")
+    time_requests(Embeddings, "embeddings")
+
+    config = {key: getattr(args, key) for key in ("latency_ms", "jitter_ms", "rate_limit_every", "retry_after_ms", "dim")}
+    report = {"config": config, "results": {}}
+    try:
+        for size in args.sizes:
+            print(f"\n=== {size} ===")
+            report["results"][size] = run_size(size, server, args.stages, args.dim)
+    finally:
+        server.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    for size, results in report["results"].items():
+        print_results(size, results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+    if args.save_baseline:
+        baseline = {"config": config, "results": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+            if baseline["config"] != config:
+                baseline = {"config": config, "results": {}}
+        for size, results in report["results"].items():
+            baseline["results"].setdefault(size, {}).update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=1)
+        print(f"\nSaved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            failures, compared = check_regressions(report, json.load(f), args.tolerance)
+        if failures:
+            print("\nThroughput regressions:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+        if not compared:
+            # a run that checks nothing must not pass for one that found no regression
+            print(f"\nNothing to compare against in {args.baseline}; run with --save-baseline to record a baseline for these settings")
+            sys.exit(1)
+        print(f"\nNo stage is slower than the baseline allows ({compared} compared)")
+    else:
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to record one")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
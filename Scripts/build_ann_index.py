@@ -0,0 +1,75 @@
+import sys
+import time
+import argparse
+import numpy as np
+from util.embedding_store import load_embeddings
+from util.embeddings_utils import normalize_rows, top_k_indices
+from util.ann_index import IVFIndex, index_path, DEFAULT_N_PROBE
+    #python3 Scripts/build_ann_index.py Data/anki_embeddings.csv
+    #python3 Scripts/build_ann_index.py Data/anki_embeddings.csv --bench --queries lecture_learning_objectives.csv
+
+BENCH_K = (10, 100, 500)
+BENCH_N_PROBE = (1, 2, 4, 8, 16, 32, 64)
+BENCH_QUERIES = 200
+
+
+def bench_queries(card_matrix, queries_path, n_queries, seed=0):
+    if queries_path:
+        _, queries = load_embeddings(queries_path)
+        return normalize_rows(queries)
+    # Without real objectives, use perturbed deck vectors as stand-in queries
+    rng = np.random.default_rng(seed)
+    picks = card_matrix[rng.choice(len(card_matrix), min(n_queries, len(card_matrix)), replace=False)]
+    noise = rng.standard_normal(picks.shape).astype(np.float32) * 0.02
+    return normalize_rows(picks + noise)
+
+
+def bench(index, card_matrix, queries):
+    """Print recall@k and per-query latency of the index against exact search for a range of n_probe."""
+    card_matrix = normalize_rows(card_matrix)
+
+    start = time.perf_counter()
+    exact = [top_k_indices(card_matrix @ q, max(BENCH_K)) for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"{len(queries)} queries over {len(card_matrix)} cards, {index.n_lists} lists")
+    print(f"exact search: {exact_ms:.2f} ms/query")
+
+    header = "n_probe  ms/query  speed-up  " + "  ".join(f"recall@{k:<4}" for k in BENCH_K)
+    print(header)
+    for n_probe in BENCH_N_PROBE:
+        if n_probe > index.n_lists:
+            break
+        start = time.perf_counter()
+        results = [index.search(card_matrix, q, max(BENCH_K), n_probe)[0] for q in queries]
+        ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recalls = [np.mean([len(np.intersect1d(found[:k], truth[:k])) / min(k, len(truth))
+                            for found, truth in zip(results, exact)]) for k in BENCH_K]
+        print(f"{n_probe:7d}  {ann_ms:8.2f}  {exact_ms / ann_ms:7.1f}x  " + "  ".join(f"{r:11.3f}" for r in recalls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an approximate nearest-neighbour index next to a deck embedding file.")
+    parser.add_argument("emb_path", help="Deck embeddings, eg. Data/anki_embeddings.csv")
+    parser.add_argument("--lists", type=int, default=None, help="Number of IVF lists (default 2*sqrt(cards))")
+    parser.add_argument("--nprobe", type=int, default=DEFAULT_N_PROBE, help="Lists searched per query by select_cards.py")
+    parser.add_argument("--bench", action="store_true", help="Report recall@k and latency against exact search")
+    parser.add_argument("--queries", default=None, help="Learning objectives to benchmark with instead of sampled cards")
+    args = parser.parse_args()
+
+    _, card_matrix = load_embeddings(args.emb_path)
+    if len(card_matrix) == 0:
+        print(f"{args.emb_path} has no embeddings.")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    index = IVFIndex.build(card_matrix, n_lists=args.lists, n_probe=args.nprobe)
+    path = index_path(args.emb_path)
+    index.save(path)
+    print(f"Built {index.n_lists}-list index over {len(card_matrix)} cards in {time.perf_counter() - start:.1f}s: {path}")
+
+    if args.bench:
+        bench(index, card_matrix, bench_queries(card_matrix, args.queries, BENCH_QUERIES))
+
+
+if __name__ == "__main__":
+    main()
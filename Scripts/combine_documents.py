@@ -1,62 +1,78 @@
 import os
 import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import fitz  # PyMuPDF
 from docx import Document
 from pptx import Presentation
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from util.lecture_text import text_path, write_pages
+from util import telemetry
+
+SOURCE_EXTENSIONS = ('.pdf', '.docx', '.pptx')
 
 
 def extract_text_from_pdf(pdf_file):
-    text = ""
+    # one entry per page
     with fitz.open(pdf_file) as pdf:
-        for page in pdf:
-            text += page.get_text() + "\n"
-    return text.strip()
+        return [page.get_text().strip() for page in pdf]
 
 
 def extract_text_from_docx(docx_file):
+    # Word documents have no fixed pages, so the whole document is one entry
     doc = Document(docx_file)
-    full_text = []
-    for para in doc.paragraphs:
-        full_text.append(para.text)
-    return '\n'.join(full_text).strip()
+    return ['\n'.join(para.text for para in doc.paragraphs).strip()]
 
 
 def extract_text_from_pptx(pptx_file):
+    # one entry per slide
     prs = Presentation(pptx_file)
-    text = ""
-    for slide in prs.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                text += shape.text + "\n"
-    return text.strip()
-
-
-def combine_texts_to_pdf(folder_path, output_pdf_path):
-    combined_text = ""
-
-    # Process PDF files
-    pdf_files = [f for f in os.listdir(folder_path) if f.lower().endswith('.pdf')]
-    for pdf_file in pdf_files:
-        full_path = os.path.join(folder_path, pdf_file)
-        print(f"Extracting text from {full_path}")
-        combined_text += extract_text_from_pdf(full_path) + "\n\n"
-
-    # Process DOCX files
-    docx_files = [f for f in os.listdir(folder_path) if f.lower().endswith('.docx')]
-    for docx_file in docx_files:
-        full_path = os.path.join(folder_path, docx_file)
-        print(f"Extracting text from {full_path}")
-        combined_text += extract_text_from_docx(full_path) + "\n\n"
-
-    # Process PPTX files
-    pptx_files = [f for f in os.listdir(folder_path) if f.lower().endswith('.pptx')]
-    for pptx_file in pptx_files:
-        full_path = os.path.join(folder_path, pptx_file)
-        print(f"Extracting text from {full_path}")
-        combined_text += extract_text_from_pptx(full_path) + "\n\n"
+    return ['\n'.join(shape.text for shape in slide.shapes if hasattr(shape, "text")).strip()
+            for slide in prs.slides]
+
+
+def extract_pages(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.pdf':
+        return extract_text_from_pdf(path)
+    if extension == '.docx':
+        return extract_text_from_docx(path)
+    return extract_text_from_pptx(path)
+
+
+def source_files(folder_path):
+    # PDFs, then Word documents, then slides, as the combined PDF has always been ordered
+    names = os.listdir(folder_path)
+    return [os.path.join(folder_path, f) for extension in SOURCE_EXTENSIONS
+            for f in names if f.lower().endswith(extension)]
+
+
+def combine_texts(folder_path, output_text_path, output_pdf_path=None):
+    """
+    Extract every source file in folder_path in parallel and write the pages, in order, to output_text_path.
+    Also renders them into one PDF if output_pdf_path is given.
+    """
+    paths = source_files(folder_path)
+    all_pages = []
+    with telemetry.stage("combine.extract"), open(output_text_path + '.tmp', 'w', encoding='utf-8') as f, \
+            ProcessPoolExecutor(max_workers=max(1, min(len(paths), os.cpu_count() or 1))) as executor:
+        # map yields in submission order, so each file is written as soon as it and those before it are done
+        for path, pages in zip(paths, executor.map(extract_pages, paths)):
+            print(f"Extracted {len(pages)} pages from {path}")
+            write_pages(f, os.path.basename(path), pages)
+            if output_pdf_path:
+                all_pages += pages
+    os.replace(output_text_path + '.tmp', output_text_path)
+
+    if output_pdf_path:
+        with telemetry.stage("combine.pdf"):
+            render_pdf(all_pages, output_pdf_path)
+
+
+def render_pdf(pages, output_pdf_path):
+    # reportlab is only needed for the optional PDF
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 
     # Create a PDF with the combined text using reportlab
     doc = SimpleDocTemplate(output_pdf_path, pagesize=letter,
@@ -69,7 +85,7 @@ def combine_texts_to_pdf(folder_path, output_pdf_path):
     story = []
 
     # Split the combined text into paragraphs
-    for paragraph in combined_text.split('\n\n'):
+    for paragraph in '\n\n'.join(pages).split('\n\n'):
         p = Paragraph(paragraph, normal_style)
         story.append(p)
         story.append(Spacer(1, 12))  # Add a small space between paragraphs
@@ -77,7 +93,7 @@ def combine_texts_to_pdf(folder_path, output_pdf_path):
     doc.build(story)
 
 
-def main():
+def main(write_pdf=False):
     script_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.join(script_dir, '..')  # Move up one directory to the project root
     lectures_folder = os.path.join(project_root, "Lectures")
@@ -91,10 +107,16 @@ def main():
 
         if os.path.isdir(full_lecture_path):
             print(f"Processing lecture folder: {full_lecture_path}")
-            output_pdf_path = os.path.join(project_root, f"{lecture_subfolder}.pdf")
-            combine_texts_to_pdf(full_lecture_path, output_pdf_path)
-            print(f"Combined text saved to {output_pdf_path}")
+            output_text_path = text_path(project_root, lecture_subfolder)
+            output_pdf_path = os.path.join(project_root, f"{lecture_subfolder}.pdf") if write_pdf else None
+            combine_texts(full_lecture_path, output_text_path, output_pdf_path)
+            print(f"Combined text saved to {output_text_path}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Extract the text of each Lectures/<lecture> folder into <lecture>_text.jsonl.")
+    parser.add_argument("--pdf", action="store_true", help="Also render the combined text to <lecture>.pdf")
+    parser.add_argument("--profile", action="store_true", help="Write a cProfile of the run to Data/telemetry")
+    args = parser.parse_args()
+    with telemetry.run("combine", args.profile):
+        main(args.pdf)
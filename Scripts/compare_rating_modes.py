@@ -0,0 +1,82 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+from util.embedding_store import load_embeddings
+from select_cards import (construct_prompt, construct_batch_prompt, tokens_in_prompt, rate_card, rate_batch,
+                          make_candidate_search, set_api_key, use_structured_scoring, RATING_WINDOW, GOOD_MATCH_SCORE)
+from tag_deck import relevance_tag
+    #python3 Scripts/compare_rating_modes.py Data/anki_embeddings.csv lecture_learning_objectives.csv --batch 10
+
+
+def relevance_tier(score):
+    # the tier tag_deck.py would tag the card with, or None if it would not be tagged
+    return relevance_tag("", score)
+
+
+def rate_single(obj, batch, executor):
+    scores = [score for _, score in executor.map(lambda card: rate_card(obj, card), [card for _, card in batch])]
+    tokens = sum(tokens_in_prompt(construct_prompt(obj, card, structured=use_structured_scoring())) for _, card in batch)
+    return scores, len(batch), tokens
+
+
+def rate_batched(obj, batch, batch_size, executor):
+    chunks = [batch[i:i + batch_size] for i in range(0, len(batch), batch_size)]
+    results = executor.map(lambda chunk: rate_batch(obj, chunk), chunks)
+    scores = [score for chunk_results in results for _, score in chunk_results]
+    tokens = sum(tokens_in_prompt(construct_batch_prompt(obj, chunk)) for chunk in chunks)
+    return scores, len(chunks), tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare single-card and batched rating on the top candidates of some objectives.")
+    parser.add_argument("emb_path")
+    parser.add_argument("obj_path")
+    parser.add_argument("--batch", type=int, default=10, help="Cards per batched request")
+    parser.add_argument("--objectives", type=int, default=5, help="Objectives to sample")
+    parser.add_argument("--cards", type=int, default=30, help="Top candidates rated per objective")
+    args = parser.parse_args()
+
+    emb_df, card_matrix = load_embeddings(args.emb_path)
+    obj_df, obj_matrix = load_embeddings(args.obj_path)
+    candidates = make_candidate_search(args.emb_path, card_matrix, obj_matrix, exact=True)
+    guids = emb_df['guid'].to_numpy()
+    cards = emb_df['card'].to_numpy()
+
+    single_scores, batched_scores = [], []
+    single_requests = batched_requests = single_tokens = batched_tokens = 0
+    with ThreadPoolExecutor(max_workers=RATING_WINDOW) as executor:
+        for obj_index, obj in enumerate(obj_df.learning_objective[:args.objectives]):
+            batch = [(guids[i], cards[i]) for i, _ in islice(candidates(obj_index), args.cards)]
+            scores, requests, tokens = rate_single(obj, batch, executor)
+            single_scores += scores
+            single_requests += requests
+            single_tokens += tokens
+            scores, requests, tokens = rate_batched(obj, batch, args.batch, executor)
+            batched_scores += scores
+            batched_requests += requests
+            batched_tokens += tokens
+            print(f"Objective {obj_index}: rated {len(batch)} cards both ways")
+
+    pairs = [(a, b) for a, b in zip(single_scores, batched_scores) if a != "NA" and b != "NA"]
+    single = np.array([a for a, _ in pairs], dtype=float)
+    batched = np.array([b for _, b in pairs], dtype=float)
+    if len(pairs) == 0:
+        print("No comparable scores.")
+        return
+
+    rank = lambda x: np.argsort(np.argsort(x))
+    spearman = np.corrcoef(rank(single), rank(batched))[0, 1] if len(pairs) > 1 else float("nan")
+    print(f"\nCards compared: {len(pairs)} (batch size {args.batch})")
+    print(f"Requests:       single {single_requests}, batched {batched_requests} ({single_requests / max(batched_requests, 1):.1f}x fewer)")
+    print(f"Prompt tokens:  single {single_tokens}, batched {batched_tokens} ({1 - batched_tokens / max(single_tokens, 1):.0%} less)")
+    print(f"Mean |diff|:    {np.mean(np.abs(single - batched)):.1f} points")
+    print(f"Spearman rho:   {spearman:.3f}")
+    print(f"Same side of {GOOD_MATCH_SCORE} (poor match rule): {np.mean((single > GOOD_MATCH_SCORE) == (batched > GOOD_MATCH_SCORE)):.0%}")
+    print(f"Same tag tier:  {np.mean([relevance_tier(a) == relevance_tier(b) for a, b in pairs]):.0%}")
+
+
+if __name__ == "__main__":
+    set_api_key()
+    main()
@@ -0,0 +1,55 @@
+import sys
+import time
+import os
+import numpy as np
+from util.embedding_store import convert_csv, is_legacy_csv, legacy_backup_path, load_legacy_csv, load_store, matrix_path
+    #python3 Scripts/convert_embeddings.py Data/anki_embeddings.csv [more.csv ...]
+    #python3 Scripts/convert_embeddings.py --bench Data/anki_embeddings.csv
+
+BENCH_REPEATS = 3
+
+
+def file_size_mb(*paths):
+    return sum(os.path.getsize(p) for p in paths) / 1e6
+
+
+def time_load(load, repeats=BENCH_REPEATS):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        _, matrix = load()
+        # touch every value so the memory-mapped load is not measured as free
+        float(np.asarray(matrix, dtype=np.float64).sum())
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench(path):
+    if is_legacy_csv(path):
+        convert_csv(path)
+    legacy = legacy_backup_path(path)
+    if not os.path.exists(legacy):
+        print(f"No legacy CSV found for {path}, nothing to compare against.")
+        return
+
+    csv_time = time_load(lambda: load_legacy_csv(legacy))
+    mmap_time = time_load(lambda: load_store(path, mmap=True))
+    ram_time = time_load(lambda: load_store(path, mmap=False))
+
+    print(f"Legacy CSV:  {file_size_mb(legacy):8.1f} MB  load {csv_time:.3f}s")
+    print(f"Binary store:{file_size_mb(path, matrix_path(path)):8.1f} MB  load {ram_time:.3f}s (read), {mmap_time:.3f}s (mmap)")
+    print(f"Speed-up: {csv_time / max(ram_time, 1e-9):.0f}x")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    run_bench = "--bench" in args
+    paths = [a for a in args if a != "--bench"]
+    if not paths:
+        print("Usage: convert_embeddings.py [--bench] <embeddings.csv> [<embeddings.csv> ...]")
+        sys.exit(1)
+    for path in paths:
+        if run_bench:
+            bench(path)
+        else:
+            convert_csv(path)
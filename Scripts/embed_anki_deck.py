@@ -1,9 +1,19 @@
 import os
+import re
+import html
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import openai
 import pandas as pd
 import tiktoken
-from util.embeddings_utils import get_embedding
+from util.embeddings_utils import get_embedding, get_embeddings
+from util.embedding_cache import EmbeddingCache, embed_with_cache, DEFAULT_CACHE_PATH
+from util.embedding_store import save_store, store_exists, load_embeddings
+from util.apkg import read_collection
+from util import telemetry
 from tqdm import tqdm
 
 # OpenAI Configuration
@@ -12,6 +22,13 @@ EMBEDDING_MODEL = "text-embedding-3-small"
 #EMBEDDING_MODEL = "text-embedding-ada-002"
 EMBEDDING_ENCODING = "cl100k_base"
 MAX_TOKENS = 8000
+
+# Batching: the embeddings endpoint takes up to 2048 inputs per request, and
+# caps the total tokens of a request, so batches are bounded by both.
+BATCH_SIZE = 2048
+BATCH_MAX_TOKENS = 250000
+MAX_CONCURRENT_BATCHES = 4
+FIELD_SEPARATOR = "\x1f"
     #python3 embed_anki_deck.py anki.txt
 
 def set_api_key(api_key):
@@ -23,6 +40,49 @@ def load_dataset(input_datapath):
     df = pd.read_csv(input_datapath, sep='\t', header=None, usecols=[0,1], names=["guid", "card"], comment='#').dropna()
     return df
 
+def strip_html(field):
+    # roughly what Anki's plain text export does to a field
+    field = re.sub(r"<br\s*/?>|</div>|</p>", " ", field, flags=re.IGNORECASE)
+    field = re.sub(r"<[^>]+>", "", field)
+    return " ".join(html.unescape(field).split())
+
+def load_apkg(apkg_path):
+    """guid, modification time and first field (HTML stripped) of every note in the .apkg's collection."""
+    assert os.path.exists(apkg_path), f"{apkg_path} does not exist. Please check your file path."
+
+    with read_collection(apkg_path) as collection_path:
+        conn = sqlite3.connect(collection_path)
+        try:
+            rows = conn.execute("SELECT guid, mod, flds FROM notes ORDER BY id").fetchall()
+        finally:
+            conn.close()
+    df = pd.DataFrame([(guid, mod, strip_html(flds.split(FIELD_SEPARATOR)[0])) for guid, mod, flds in rows],
+                      columns=["guid", "mod", "card"])
+    return df[df.card != ""]
+
+def split_unchanged(df, store_path):
+    """
+    Split deck notes into those whose stored embedding is still current (same guid and mod), returned
+    with their stored tokens and vectors, and those that are new or modified. Deleted notes are dropped.
+    """
+    if not store_exists(store_path):
+        return None, df
+    old_df, old_matrix = load_embeddings(store_path, mmap=False)
+    if "mod" not in old_df.columns:
+        print(f"{store_path} has no modification times; embedding every note (cached embeddings are reused)")
+        return None, df
+
+    old_rows = {(guid, mod): i for i, (guid, mod) in enumerate(zip(old_df.guid, old_df["mod"]))}
+    positions = [old_rows.get((guid, mod), -1) for guid, mod in zip(df.guid, df["mod"])]
+    current = [position >= 0 for position in positions]
+    unchanged = df[current].copy()
+    unchanged["tokens"] = old_df.tokens.to_numpy()[[p for p in positions if p >= 0]]
+    unchanged["emb"] = list(old_matrix[[p for p in positions if p >= 0]])
+
+    deleted = len(set(old_df.guid) - set(df.guid))
+    print(f"{len(unchanged)} notes unchanged, {len(df) - len(unchanged)} new or modified, {deleted} deleted since the last run")
+    return unchanged, df[[not c for c in current]]
+
 def filter_by_tokens(df, encoding):
     df["tokens"] = df.card.apply(lambda x: len(encoding.encode(x)))
     return df[df.tokens <= MAX_TOKENS]
@@ -30,10 +90,80 @@ def filter_by_tokens(df, encoding):
 def calculate_embeddings(df):
     return [get_embedding(card, model=EMBEDDING_MODEL) for card in tqdm(df.card, desc="Calculating embeddings", dynamic_ncols=True)]
 
-def save_embeddings(df, output_prefix):
-    df.to_csv(f"./{output_prefix}_embeddings.csv", index=False)
+def make_batches(tokens, batch_size=BATCH_SIZE, max_tokens=BATCH_MAX_TOKENS):
+    """Split rows into consecutive (start, end) ranges bounded by card count and token total."""
+    batches = []
+    start = 0
+    batch_tokens = 0
+    for i, n_tokens in enumerate(tokens):
+        if i > start and (i - start >= batch_size or batch_tokens + n_tokens > max_tokens):
+            batches.append((start, i))
+            start = i
+            batch_tokens = 0
+        batch_tokens += n_tokens
+    if start < len(tokens):
+        batches.append((start, len(tokens)))
+    return batches
+
+def report_throughput(n_cards, n_tokens, n_batches, elapsed):
+    elapsed = max(elapsed, 1e-9)
+    print(f"Embedded {n_cards} cards ({n_tokens} tokens) in {n_batches} batches over {elapsed:.1f}s: "
+          f"{n_cards / elapsed:.1f} cards/sec, {n_tokens / elapsed:.0f} tokens/sec")
+
+def calculate_embeddings_batched(df, batch_size=BATCH_SIZE, max_tokens=BATCH_MAX_TOKENS, max_workers=MAX_CONCURRENT_BATCHES):
+    cards = df.card.tolist()
+    batches = make_batches(df.tokens.tolist(), batch_size, max_tokens)
+    results = [None] * len(batches)
 
-def main():
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(total=len(cards), desc="Calculating embeddings", dynamic_ncols=True) as pbar:
+        futures = {executor.submit(get_embeddings, cards[start:end], model=EMBEDDING_MODEL): n
+                   for n, (start, end) in enumerate(batches)}
+        for future in as_completed(futures):
+            n = futures[future]
+            results[n] = future.result()
+            pbar.update(len(results[n]))
+    report_throughput(len(cards), int(df.tokens.sum()), len(batches), time.perf_counter() - start_time)
+
+    # Batches finish in any order; results are stitched back in input order.
+    return [emb for batch in results for emb in batch]
+
+def calculate_embeddings_cached(df, cache, **batch_kwargs):
+    # Only cache misses go to the API; everything else comes from the shared embedding cache.
+    tokens_by_card = dict(zip(df.card, df.tokens))
+
+    def embed_missing(cards):
+        print(f"{len(cards)} of {len(df)} cards not in the embedding cache")
+        misses = pd.DataFrame({"card": cards, "tokens": [tokens_by_card[card] for card in cards]})
+        return calculate_embeddings_batched(misses, **batch_kwargs)
+
+    embeddings = embed_with_cache(df.card.tolist(), EMBEDDING_MODEL, embed_missing, cache)
+    print(f"Embedding cache: {cache.hits} hits, {cache.misses} misses")
+    return embeddings
+
+def save_embeddings(df, output_path):
+    # guid/card/tokens (and mod for .apkg decks) go to the .csv, the vectors to a float32 .npy next to it
+    columns = [column for column in ["guid", "card", "tokens", "mod"] if column in df.columns]
+    save_store(df[columns], df.emb.tolist(), output_path)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Embed the notes of an Anki deck (.apkg) or plain text export.")
+    parser.add_argument("input_datapath", nargs="?", default="./anki.txt",
+                        help="The deck's .apkg, or notes exported as plain text with the GUID column included")
+    parser.add_argument("--output", default=None,
+                        help="Embedding store to write (default <dir>/anki_embeddings.csv for an .apkg, <input>_embeddings.csv otherwise)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Max cards per embeddings request")
+    parser.add_argument("--batch-tokens", type=int, default=BATCH_MAX_TOKENS, help="Max tokens per embeddings request")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_BATCHES, help="Max requests in flight")
+    parser.add_argument("--serial", action="store_true", help="Embed one card per request (old behaviour)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="Embedding cache shared across decks and scripts")
+    parser.add_argument("--no-cache", action="store_true", help="Re-embed every card, ignoring the cache")
+    parser.add_argument("--profile", action="store_true", help="Write a cProfile of the run to Data/telemetry")
+    return parser.parse_args()
+
+def main(args=None):
+    args = args or parse_args()
     api_key = os.environ.get(OPENAI_API_KEY_ENV_VAR)
     assert api_key, f"Set your OpenAI API key as an environment variable named '{OPENAI_API_KEY_ENV_VAR}'"
 
@@ -43,19 +173,44 @@ def main():
     # Set deck to embed.
     #This is the deck you'll apply your tags to in the end.
     #In anki, export deck notes as plain text with GUID flag checked
-    input_datapath = "./anki.txt"
-    output_prefix = "anki" # EDIT AS NEEDED
+    input_datapath = args.input_datapath
+    unchanged = None
+    with telemetry.stage("embed.load"):
+        if input_datapath.endswith(".apkg"):
+            # Read the notes straight from the deck; only notes added or edited since the last run are embedded
+            output_path = args.output or os.path.join(os.path.dirname(input_datapath), "anki_embeddings.csv")
+            df = load_apkg(input_datapath)
+            unchanged, df = split_unchanged(df, output_path)
+        else:
+            output_path = args.output or os.path.splitext(input_datapath)[0] + "_embeddings.csv" # eg. Data/anki -> Data/anki_embeddings.csv
+            df = load_dataset(input_datapath)
 
-    # Load and preprocess dataset
-    df = load_dataset(input_datapath)
-    encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
-    df = filter_by_tokens(df, encoding)
+        # Load and preprocess dataset
+        encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
+        df = filter_by_tokens(df, encoding)
 
     # Calculate embeddings for cards
-    df["emb"] = calculate_embeddings(df)
+    with telemetry.stage("embed.embeddings"):
+        if len(df) == 0:
+            df["emb"] = []
+        elif args.serial:
+            df["emb"] = calculate_embeddings(df)
+        elif args.no_cache:
+            df["emb"] = calculate_embeddings_batched(df, args.batch_size, args.batch_tokens, args.workers)
+        else:
+            cache = EmbeddingCache(args.cache)
+            df["emb"] = calculate_embeddings_cached(df, cache, batch_size=args.batch_size,
+                                                    max_tokens=args.batch_tokens, max_workers=args.workers)
+            cache.close()
+
+    if unchanged is not None:
+        df = pd.concat([unchanged, df]).sort_index()  # back in deck order
 
     # Save embeddings to file
-    save_embeddings(df, output_prefix)
+    with telemetry.stage("embed.save"):
+        save_embeddings(df, output_path)
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    with telemetry.run("embed", args.profile):
+        main(args)
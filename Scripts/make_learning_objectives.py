@@ -1,13 +1,42 @@
-import os, re, sys, csv, glob, time
+import os, re, sys, json
+import argparse
 import openai
+import numpy as np
+import pandas as pd
 import tiktoken
 import pdfplumber
-from openai import RateLimitError, APIError
-from util.embeddings_utils import get_embedding
+from util.embeddings_utils import get_embeddings, normalize_rows
+from util.embedding_cache import embed_with_cache, get_default_cache as get_embedding_cache
+from util.embedding_store import save_store
+from util.response_cache import cached_chat_completion, get_default_cache
+from util.lecture_text import is_lecture_text, lecture_name, load_pages, TEXT_SUFFIX
+from util import telemetry
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 MAX_TOKENS = 16000
 TOKEN_BUFFER = 2000
+# Pages are packed into requests of up to CHUNK_TOKENS of material, OBJECTIVE_WORKERS requests at a time
+CHUNK_TOKENS = 3000
+OBJECTIVE_WORKERS = 8
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_ENCODING = "cl100k_base"
+EMBEDDING_BATCH_SIZE = 2048
+# Objectives of the same lecture at least this cosine-similar are merged into one before card selection
+DEDUP_THRESHOLD = 0.92
+
+SYSTEM_MESSAGE = ("You are receiving lecture material for a medical school lesson. Use the following principles when making learning objectives (LO).\n\n"
+                  "Material: \"Source Material\"\n\n"
+                  "Task: Your task is to analyze the Source Material and condense the information into concise and direct learning objectives. Ensure that learning objectives are clearly written at a level appropriate for medical students while being easily understandable, and adheres to the specified formatting and reference criteria.\n\n"
+                  "Formatting Criteria:\n"
+                  "- Each LO needs to be succinct, precise, and exactly aligns with the Source Material.\n"
+                  "- Each LO must be unique, with minimal overlapping information and stand on their own.\n"
+                  "- Limit the word count of each Learning Objective to single sentences with less than 25 words.\n"
+                  "- If a abbreviation or acronym is mentioned, include both the long name and the short name in each LO.\n\
+                      Reference Criteria:\n"
+                  "- Each LO must include at most two key terms on pathogenesis, pathophysiology, symptoms, treatments, diagnostics, etc., if mentioned in the Source Material.\n"
+                  "- If material is briefly mentioned as a roadmap and/or stated to be explored in another lecture, ignore it.\n"
+                  "- Do not include material that isn't mentioned in the source material.")
 
 
 def set_api_key():
@@ -18,26 +47,18 @@ def set_api_key():
             "Set your OpenAI API key as an environment variable named 'OPENAI_API_KEY' eg In terminal: export OPENAI_API_KEY=your-api-key")
 
 
-def handle_api_error(func):
-    def wrapper(*args, **kwargs):
-        while True:
-            try:
-                return func(*args, **kwargs)
-            except APIError as e:
-                if isinstance(e, RateLimitError):
-                    print(f"RateLimitError occurred: {e}")
-                else:
-                    print(f"APIError occurred: {e}")
-                print(f"Error code: {e.code}")
-                time.sleep(10)  # wait for 10 seconds before retrying
+_encodings = {}
+
 
-    return wrapper
+def get_encoding(name="gpt-4o-mini"):
+    # tokenizers are loaded once per process, not once per page or objective
+    if name not in _encodings:
+        _encodings[name] = tiktoken.encoding_for_model(name) if name.startswith("gpt") else tiktoken.get_encoding(name)
+    return _encodings[name]
 
 
 def count_tokens(text):
-    enc = tiktoken.encoding_for_model("gpt-4o-mini")
-    tokens = list(enc.encode(text))
-    return len(tokens)
+    return len(get_encoding().encode(text))
 
 
 def extract_text_from_pdf(pdf_file):
@@ -46,32 +67,26 @@ def extract_text_from_pdf(pdf_file):
     return text_pages
 
 
-def generate_questions(prompt, temperature=1.0):
-    system_message = ("You are receiving lecture material for a medical school lesson. Use the following principles when making learning objectives (LO).\n\n"
-                      "Material: \"Source Material\"\n\n"
-                      "Task: Your task is to analyze the Source Material and condense the information into concise and direct learning objectives. Ensure that learning objectives are clearly written at a level appropriate for medical students while being easily understandable, and adheres to the specified formatting and reference criteria.\n\n"
-                      "Formatting Criteria:\n"
-                      "- Each LO needs to be succinct, precise, and exactly aligns with the Source Material.\n"
-                      "- Each LO must be unique, with minimal overlapping information and stand on their own.\n"
-                      "- Limit the word count of each Learning Objective to single sentences with less than 25 words.\n"
-                      "- If a abbreviation or acronym is mentioned, include both the long name and the short name in each LO.\n\
-                      Reference Criteria:\n"
-                      "- Each LO must include at most two key terms on pathogenesis, pathophysiology, symptoms, treatments, diagnostics, etc., if mentioned in the Source Material.\n"
-                      "- If material is briefly mentioned as a roadmap and/or stated to be explored in another lecture, ignore it.\n"
-                      "- Do not include material that isn't mentioned in the source material.")
+def extract_pages(lecture_file):
+    # <lecture>_text.jsonl from combine_documents.py, or a PDF
+    if is_lecture_text(lecture_file):
+        return load_pages(lecture_file)
+    return extract_text_from_pdf(lecture_file)
 
-    formatted_prompt = [{"role": "system", "content": system_message},
+
+def generate_questions(prompt, temperature=1.0):
+    formatted_prompt = [{"role": "system", "content": SYSTEM_MESSAGE},
                         {"role": "user", "content": prompt}]
 
-    total_tokens = count_tokens(system_message) + count_tokens(prompt)
+    total_tokens = count_tokens(SYSTEM_MESSAGE) + count_tokens(prompt)
     remaining_tokens = MAX_TOKENS - total_tokens - TOKEN_BUFFER
 
     if remaining_tokens < 0:
-        print(f"Warning! Input text is longer than model gpt-4o can support. Consider trimming input and trying again.")
+        print("Warning! Input text is longer than model gpt-4o can support. Consider trimming input and trying again.")
         print(f"Current length: {total_tokens}, recommended < {MAX_TOKENS - TOKEN_BUFFER}")
         raise ValueError('Input text too long')
 
-    completion = openai.chat.completions.create(
+    completion = cached_chat_completion(
         model="gpt-4o-mini",
         messages=formatted_prompt,
         max_tokens=remaining_tokens,
@@ -79,109 +94,174 @@ def generate_questions(prompt, temperature=1.0):
         stop=None,
         temperature=temperature)
 
-    return completion.choices[0].message.content.strip()
+    return completion.strip()
+
+
+def pack_pages(text_pages, max_page_tokens, chunk_tokens=CHUNK_TOKENS):
+    """
+    Group consecutive pages into chunks of up to chunk_tokens, as lists of (page number, text).
+    Blank pages are dropped and a page longer than max_page_tokens is truncated to it.
+    """
+    enc = get_encoding()
+    chunks, chunk, chunk_size = [], [], 0
+    for page_number, (page_text, tokens) in enumerate(zip(text_pages, enc.encode_batch(text_pages)), start=1):
+        if not page_text.strip():
+            continue
+        if len(tokens) > max_page_tokens:
+            # Truncate the page to fit within the token limit
+            page_text, tokens = enc.decode(tokens[:max_page_tokens]), tokens[:max_page_tokens]
+        if chunk and chunk_size + len(tokens) > chunk_tokens:
+            chunks.append(chunk)
+            chunk, chunk_size = [], 0
+        chunk.append((page_number, page_text))
+        chunk_size += len(tokens)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def chunk_prompt(chunk):
+    # Page markers keep each page's context apart, and restarting the numbering on every page
+    # keeps the per-page "1./2./3." selection below the same as with one request per page
+    material = "\n\n".join(f"[Page {page_number}]\n{page_text}" for page_number, page_text in chunk)
+    return (f"Material: \"{material}\"\n\n"
+            "Learning Objectives based on Source Material. Write the objectives for each page under its own "
+            "[Page n] heading, numbering them from 1 again for every page:")
+
+
+def parse_objectives(generated_text):
+    # Extract learning objectives from the response
+    objectives = []
+    for line in generated_text.split("\n"):
+        line_strip = line.strip()
+        if line_strip.startswith("1. ") or line_strip.startswith("2. ") or line_strip.startswith("3. "):
+            objectives.append(line_strip)
+    return objectives
 
 
-@handle_api_error
 def define_objectives_from_pdf(pdf_file, temperature=1.0):
-    text_pages = extract_text_from_pdf(pdf_file)
-    all_objectives = []
-
-    system_message = ("You are receiving lecture material for a medical school lesson. Use the following principles when making learning objectives (LO).\n\n"
-                      "Material: \"Source Material\"\n\n"
-                      "Task: Your task is to analyze the Source Material and condense the information into concise and direct learning objectives. Ensure that learning objectives are clearly written at a level appropriate for medical students while being easily understandable, and adheres to the specified formatting and reference criteria.\n\n"
-                      "Formatting Criteria:\n"
-                      "- Each LO needs to be succinct, precise, and exactly aligns with the Source Material.\n"
-                      "- Each LO must be unique, with minimal overlapping information and stand on their own.\n"
-                      "- Limit the word count of each Learning Objective to single sentences with less than 25 words.\n"
-                      "- If an abbreviation or acronym is mentioned, include both the expanded name and the abbreviation/acronym in each LO that mentions them.\n\n"
-                      "Reference Criteria:\n"
-                      "- Each LO must include at most two key terms on pathogenesis, pathophysiology, symptoms, treatments, diagnostics, etc., if mentioned in the Source Material.\n"
-                      "- If some material is briefly mentioned as a roadmap and/or stated to be explored in another lecture, ignore it.\n"
-                      "- Do not include material that isn't mentioned in the source material.")
-
-    system_token_count = count_tokens(system_message)
-    max_chunk_size = MAX_TOKENS - system_token_count - TOKEN_BUFFER
+    with telemetry.stage("objectives.extract"):
+        text_pages = extract_pages(pdf_file)
 
-    for page_number, page_text in enumerate(text_pages, start=1):
-        print(f"Processing page {page_number}/{len(text_pages)}")  # Debugging print statement
+    max_chunk_size = MAX_TOKENS - count_tokens(SYSTEM_MESSAGE) - TOKEN_BUFFER
+    chunks = pack_pages(text_pages, max_chunk_size, min(CHUNK_TOKENS, max_chunk_size))
+    print(f"Packed {len(text_pages)} pages into {len(chunks)} requests")
 
-        # Ensure the chunk does not exceed the maximum token limit minus the system message tokens
-        if count_tokens(page_text) > max_chunk_size:
-            # Truncate the chunk to fit within the token limit
-            enc = tiktoken.encoding_for_model("gpt-4o-mini")
-            tokens = list(enc.encode(page_text))
-            truncated_text = enc.decode(tokens[:max_chunk_size])
-        else:
-            truncated_text = page_text
+    with telemetry.stage("objectives.generate"), ThreadPoolExecutor(max_workers=OBJECTIVE_WORKERS) as executor:
+        replies = executor.map(lambda chunk: generate_questions(chunk_prompt(chunk), temperature), chunks)
+        return [objective for reply in replies for objective in parse_objectives(reply)]
 
-        prompt = f"Material: \"{truncated_text}\"\n\nLearning Objectives based on Source Material:"
-        generated_text = generate_questions(prompt, temperature=1.0)
 
-        # Extract learning objectives from the response
-        objectives = []
-        for line in generated_text.split("\n"):
-            line_strip = line.strip()
-            if line_strip.startswith("1. ") or line_strip.startswith("2. ") or line_strip.startswith("3. "):
-                objectives.append(line_strip)
+def embed_batch(texts):
+    return get_embeddings(texts, model=EMBEDDING_MODEL)
 
-        all_objectives.extend(objectives)
 
-    return all_objectives
+def embed_objectives(objectives):
+    """Token counts and embeddings for objectives: cache hits first, then the rest in batched requests."""
+    tokens = [len(t) for t in get_encoding(EMBEDDING_ENCODING).encode_batch(objectives)]
+    embed_fn = lambda texts: [emb for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+                              for emb in embed_batch(texts[i:i + EMBEDDING_BATCH_SIZE])]
+    return tokens, embed_with_cache(objectives, EMBEDDING_MODEL, embed_fn, get_embedding_cache())
 
 
-@handle_api_error
-def generate_embedding(obj, embedding_model="text-embedding-3-small", embedding_encoding="cl100k_base"):
-    # Set up the tokenizer
-    encoding = tiktoken.get_encoding(embedding_encoding)
-
-    # Generate the tokens and embeddings
-    tokens = len(encoding.encode(obj))
-    emb = get_embedding(obj, model=embedding_model)
-
-    return tokens, emb
-
-
-def write_to_csv(csv_writer, output_prefix, objectives):
+def add_objectives(rows, kept, output_prefix, objectives):
     n = 0
     for obj in objectives:
         obj_clean = re.sub(r'^\d+\.', '', obj).strip().lstrip('- ')
         remove_words = ['Summary', 'Learning', 'Objective', 'Guiding', 'Additional', 'Question']
         if len([word for word in remove_words if word in obj_clean]) < 2:
             n += 1
-            tokens, emb = generate_embedding(obj)
-            csv_writer.writerow([output_prefix, obj_clean, tokens, emb])
-    print(f"Wrote {n} learning objectives to file for {output_prefix}")
-
-
-def main(input_path):
+            rows.append([output_prefix, obj_clean])
+            kept.append(obj)
+    print(f"Kept {n} learning objectives for {output_prefix}")
+
+
+def cluster_duplicates(matrix, threshold=DEDUP_THRESHOLD):
+    """
+    Greedy clustering in objective order: each row joins the most similar earlier representative
+    if that is at least threshold cosine-similar, otherwise it becomes a representative.
+    Returns the representative's row number for every row.
+    """
+    sims = normalize_rows(matrix) @ normalize_rows(matrix).T
+    representative = np.arange(len(matrix))
+    reps = []
+    for i in range(len(matrix)):
+        if reps:
+            best = reps[int(np.argmax(sims[i, reps]))]
+            if sims[i, best] >= threshold:
+                representative[i] = best
+                continue
+        reps.append(i)
+    return representative
+
+
+def dedup_objectives(rows, embeddings, threshold=DEDUP_THRESHOLD):
+    """
+    Keep one objective per cluster of near-duplicates within each tag, recording the ones merged
+    into it as a JSON list in a merged_objectives column. Returns the kept rows and embeddings.
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    representative = np.arange(len(rows))
+    tags = np.array([row[0] for row in rows])
+    for tag in dict.fromkeys(tags):
+        members = np.flatnonzero(tags == tag)
+        representative[members] = members[cluster_duplicates(matrix[members], threshold)]
+
+    merged = {i: [] for i in np.unique(representative)}
+    for i, rep in enumerate(representative):
+        if i != rep:
+            merged[rep].append(rows[i][1])
+    keep = sorted(merged)
+    print(f"Collapsed {len(rows) - len(keep)} near-duplicate learning objectives (threshold {threshold}), "
+          f"{len(keep)} of {len(rows)} left")
+    return [rows[i] + [json.dumps(merged[i])] for i in keep], matrix[keep]
+
+
+def write_objectives(rows, embeddings, output_file):
+    # name/learning_objective/tokens/merged_objectives go to the .csv, the vectors to a float32 .npy next to it
+    df = pd.DataFrame(rows, columns=['name', 'learning_objective', 'tokens', 'merged_objectives'])
+    save_store(df, embeddings, output_file)
+    print(f"Wrote {len(df)} learning objectives to {output_file}")
+
+
+def main(input_path, dedup_threshold=DEDUP_THRESHOLD):
     path = Path(input_path)
-    output_prefix = path.stem
+    output_prefix = lecture_name(path)
     output_file = output_prefix + "_learning_objectives.csv"
 
     if path.is_file():
         pdf_files = [input_path]
     elif path.is_dir():
-        pdf_files = list(path.glob('*.pdf'))
+        pdf_files = list(path.glob('*.pdf')) + list(path.glob('*' + TEXT_SUFFIX))
     else:
         print("The provided path is not a valid file or directory.")
         sys.exit(1)
 
-    with open(output_file, 'a', newline='', encoding='utf-8') as csvfile:
-        csv_writer = csv.writer(csvfile)
-        csv_writer.writerow(['name', 'learning_objective', 'tokens', 'emb'])
+    rows, kept = [], []
+    for pdf_file in pdf_files:
+        print(f"Processing PDF: {pdf_file}")  # Debugging print statement
+        objectives = define_objectives_from_pdf(pdf_file)
+        tag = lecture_name(pdf_file)
+        add_objectives(rows, kept, tag, objectives)
 
-        for pdf_file in pdf_files:
-            print(f"Processing PDF: {pdf_file}")  # Debugging print statement
-            objectives = define_objectives_from_pdf(pdf_file)
-            tag = Path(pdf_file).stem
-            write_to_csv(csv_writer, tag, objectives)
+    # every kept objective of every file is embedded together
+    with telemetry.stage("objectives.embed"):
+        tokens, embeddings = embed_objectives(kept)
+    rows = [row + [n_tokens] for row, n_tokens in zip(rows, tokens)]
+    with telemetry.stage("objectives.dedup"):
+        rows, embeddings = dedup_objectives(rows, embeddings, dedup_threshold)
+    write_objectives(rows, embeddings, output_file)
+    if get_default_cache() is not None:
+        print(get_default_cache().summary())
 
 
 if __name__ == "__main__":
     set_api_key()
-    if len(sys.argv) != 2:
-        print("Usage: make_learning_objectives.py <pdf_file_or_dir>")
-        sys.exit(1)
-    path = sys.argv[1]
-    main(path)
+    parser = argparse.ArgumentParser(usage="make_learning_objectives.py <lecture_text.jsonl, pdf_file or dir> [options]")
+    parser.add_argument("path")
+    parser.add_argument("--dedup-threshold", type=float, default=DEDUP_THRESHOLD,
+                        help="Merge objectives of the same lecture at least this cosine-similar (above 1 turns merging off)")
+    parser.add_argument("--profile", action="store_true", help="Write a cProfile of the run to Data/telemetry")
+    args = parser.parse_args()
+    with telemetry.run("objectives", args.profile):
+        main(args.path, args.dedup_threshold)
@@ -1,13 +1,60 @@
 import pandas as pd
 import numpy as np
-import re, sys, csv, os
+import re, os, json
 import openai
 import tiktoken
-from openai import APIError, RateLimitError, APIConnectionError
-import time, requests
+import argparse
+import heapq
+import threading
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from itertools import islice
+from util.embedding_store import load_embeddings
+from util.embeddings_utils import normalize_rows, top_k_indices
+from util.ann_index import load_index
+from util.response_cache import cached_chat_completion, get_default_cache
+from util import telemetry
+from util.results_store import ResultsStore, DEFAULT_RESULTS_PATH
 
 MAX_POOR_MATCH_RUN = 12
+GOOD_MATCH_SCORE = 50
 MAX_TOKENS_PER_OBJ = 30000
+# Candidates taken from a partial sort per objective; the stop rules end well before this in practice.
+TOP_K_CANDIDATES = 500
+# Cards rated ahead of the one being consumed. Ratings past an objective's stop point are thrown away,
+# so a bigger window trades a little wasted spend for fewer round trips waited on.
+RATING_WINDOW = 8
+# Cards scored per request in batched mode (1 = one prompt per card), and the reply budget per card.
+RATING_BATCH_SIZE = 1
+BATCH_REPLY_TOKENS_PER_CARD = 12
+BATCH_RETRIES = 1
+# Global scheduler: all (objective, candidate) pairs of a lecture, or of a whole run, share one budget, spent
+# on the pairs with the highest cosine similarity nudged by how often that objective's recent cards matched.
+HIT_RATE_WEIGHT = 0.1
+HIT_RATE_DECAY = 0.7
+# "structured": one call per card returning JSON {"score": int, "reason": str} under a strict schema and a
+# tight reply cap. "legacy": free text scraped by clean_reply, retried with rising temperature on "NA".
+# Structured scoring falls back to legacy by itself if the model rejects response_format.
+SCORING_MODE = "structured"
+STRUCTURED_REPLY_TOKENS = 80
+SCORE_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "card_score",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"score": {"type": "integer"}, "reason": {"type": "string"}},
+            "required": ["score", "reason"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# How each card's score was obtained, reported at the end of a run
+score_stats = Counter()
+_scoring = {"structured": SCORING_MODE == "structured"}
+_scoring_lock = threading.Lock()
 
 def set_api_key():
     try:
@@ -15,55 +62,91 @@ def set_api_key():
     except KeyError:
         print("Set your OpenAI API key as an environment variable named 'OPENAI_API_KEY' eg In terminal: export OPENAI_API_KEY=your-api-key")
 
-def handle_api_error(func):
-    def wrapper(*args, **kwargs):
-        t=5
-        while True:
-            try:
-                return func(*args, **kwargs)
-            except (RateLimitError, APIError, APIConnectionError):
-                print(f'API Error. Waiting {t}s before retrying.')
-                time.sleep(t)  # wait for 10 seconds before retrying
-                t+=5
-    return wrapper
-
-def convert_to_np_array(s):
-    return np.fromstring(s.strip("[]"), sep=",")
-
-def load_emb(path):
-
-    # Specify the data types for columns 0, 1, and 2
-    column_dtypes = {0: str, 1: str, 2: int}
+def score_objectives(obj_matrix, card_matrix):
+    # One matrix multiply scores every objective against every card: (objectives x cards) cosine similarities
+    return normalize_rows(obj_matrix) @ normalize_rows(card_matrix).T
+
+def ranked_candidates(scores, k=TOP_K_CANDIDATES, top=None):
+    """
+    Yield (card index, cosine similarity) by descending similarity: the top k first,
+    the rest of the deck only if asked for. top overrides the first k (eg. from an ANN search).
+    """
+    if top is None:
+        top = top_k_indices(scores, k)
+    for card_index in top:
+        yield card_index, scores[card_index]
+    if len(top) < len(scores):
+        rest = np.ones(len(scores), dtype=bool)
+        rest[top] = False
+        rest = np.flatnonzero(rest)
+        for card_index in rest[np.argsort(-scores[rest], kind="stable")]:
+            yield card_index, scores[card_index]
+
+def ann_ranked_candidates(index, card_matrix, obj_emb, k=TOP_K_CANDIDATES):
+    top, top_scores = index.search(card_matrix, obj_emb, k)
+    for card_index, cosine_sim in zip(top, top_scores):
+        yield card_index, cosine_sim
+    # Ran past the approximate list: score this objective exactly and carry on with the cards it missed
+    yield from islice(ranked_candidates(card_matrix @ obj_emb, top=top), len(top), None)
+
+def make_candidate_search(emb_path, card_matrix, obj_matrix, exact=False):
+    """Return a function mapping an objective's row number to its ranked (card index, cosine sim) candidates."""
+    index = None if exact else load_index(emb_path, card_matrix)
+    if index is None:
+        obj_scores = score_objectives(obj_matrix, card_matrix)
+        return lambda obj_index: ranked_candidates(obj_scores[obj_index])
+
+    print(f"Searching {len(card_matrix)} cards with the ANN index ({index.n_lists} lists, n_probe={index.n_probe})")
+    card_matrix = normalize_rows(card_matrix)
+    obj_matrix = normalize_rows(obj_matrix)
+    return lambda obj_index: ann_ranked_candidates(index, card_matrix, obj_matrix[obj_index])
+
+def construct_prompt(obj,card,structured=False):
+
+    if structured:
+        reply_format = "Format: Give the score as a whole number, then the arguement for the score in less than 20 words."
+    else:
+        reply_format = "Format: Start your statement with 'Score: # (just the final score number. No need to say 90 out of 100. Just say Score: 90)' followed with the arguement for the score. Limit your response to less than 25 words."
 
-    # Read CSV file and interpret column types
-    df = pd.read_csv(
-        path,
-        dtype=column_dtypes,
-        converters={3: convert_to_np_array})
+    prompt = f"Task: Rate the relevance of the Anki card to the learning question on a scale from 0 to 100.\n\
+     Learning questions can be complex, and Anki cards may contain fragmented information that partially addresses the full scope of the question.\n\
+Instructions: Focus on how well the Anki card addresses any key concepts or foundational knowledge needed to answer the learning question.\n\
+{reply_format}\n\
+    Learning question: {obj}\n\
+    Anki card: {card}"
 
-    return df
+    formatted_prompt = [{"role": "system", "content": "You are an assistant that precisely follows instructions."},
+                        {"role": "user", "content": prompt}]
 
-def vs(x, y):
-    return np.dot(np.array(x), np.array(y))
+    return formatted_prompt
 
-def construct_prompt(obj,card):
+def construct_batch_prompt(obj,batch):
+    # batch is a list of (guid, card); the instructions and the objective are sent once for all of them
+    card_lines = "\n".join(f"    Anki card {guid}: {card}" for guid, card in batch)
 
-    prompt = f"Task: Rate the relevance of the Anki card to the learning question on a scale from 0 to 100.\n\
+    prompt = f"Task: Rate the relevance of each Anki card to the learning question on a scale from 0 to 100.\n\
      Learning questions can be complex, and Anki cards may contain fragmented information that partially addresses the full scope of the question.\n\
-Instructions: Focus on how well the Anki card addresses any key concepts or foundational knowledge needed to answer the learning question.\n\
-Format: Start your statement with 'Score: # (just the final score number. No need to say 90 out of 100. Just say Score: 90)' followed with the arguement for the score. Limit your response to less than 25 words.\n\
+Instructions: Focus on how well each Anki card addresses any key concepts or foundational knowledge needed to answer the learning question. Rate every card on its own.\n\
+Format: Reply with only a JSON object mapping each card id to its score, eg. {{\"<card id>\": 90}}. Include every card id listed below.\n\
     Learning question: {obj}\n\
-    Anki card: {card}"
+{card_lines}"
 
     formatted_prompt = [{"role": "system", "content": "You are an assistant that precisely follows instructions."},
                         {"role": "user", "content": prompt}]
 
     return formatted_prompt
 
+_encoding = None
+
+def get_encoding():
+    # loading the tokenizer is slow, so it is done once per process
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+    return _encoding
+
 def count_tokens(text):
-    enc = tiktoken.encoding_for_model("gpt-4o-mini")
-    tokens = list(enc.encode(text))
-    return len(tokens)
+    return len(get_encoding().encode(text))
 
 def tokens_in_prompt(formatted_prompt):
     formatted_prompt_str = ""
@@ -73,22 +156,75 @@ def tokens_in_prompt(formatted_prompt):
     #print(f"Tokens in prompt: {token_count}")
     return count_tokens(formatted_prompt_str)
 
-@handle_api_error
 def rate_card_for_obj(prompt, temperature=1):
     # Calculate the remaining tokens for the response
     #remaining_tokens = 16000 - tokens_in_prompt(prompt) - 20
     remaining_tokens = 16000 - 20
-    completions = openai.chat.completions.create(
+    string_return = cached_chat_completion(
         model="gpt-4o-mini",  # Use the gpt-4o-mini engine
         messages=prompt,
         max_tokens=remaining_tokens,  # Set the remaining tokens as the maximum for the response
         n=1,
         stop=None,
-        temperature=temperature)
+        temperature=temperature).strip()
 
-    string_return = completions.choices[0].message.content.strip()
     return string_return.replace('\n',' ')
 
+def rate_card_structured(prompt):
+    return cached_chat_completion(
+        model="gpt-4o-mini",
+        messages=prompt,
+        max_tokens=STRUCTURED_REPLY_TOKENS,
+        n=1,
+        response_format=SCORE_SCHEMA,
+        temperature=0).strip()
+
+def parse_structured_reply(s):
+    try:
+        score = json.loads(s)["score"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        # a reply cut off in the reason still has the score up front
+        matches = re.search(r'"score"\s*:\s*(\d{1,3})', s)
+        if not matches:
+            return "NA"
+        score = matches.group(1)
+    try:
+        score = int(score)
+    except (TypeError, ValueError):
+        return "NA"
+    return score if 0 <= score <= 100 else "NA"
+
+def rate_batch_for_obj(prompt, n_cards, temperature=0):
+    return cached_chat_completion(
+        model="gpt-4o-mini",
+        messages=prompt,
+        max_tokens=BATCH_REPLY_TOKENS_PER_CARD * n_cards + 20,
+        n=1,
+        response_format={"type": "json_object"},
+        temperature=temperature).strip()
+
+def parse_batch_reply(s, guids):
+    """Return {guid: score} for the cards the reply scored; missing or unreadable cards are left out."""
+    try:
+        reply = json.loads(s)
+    except json.JSONDecodeError:
+        # truncated or chatty JSON: take whatever "id": score pairs are readable
+        reply = dict(re.findall(r'"([^"]+)"\s*:\s*"?(\d{1,3})', s))
+    if isinstance(reply, dict) and isinstance(reply.get("scores"), dict):
+        reply = reply["scores"]
+    if not isinstance(reply, dict):
+        return {}
+
+    scores = {}
+    for guid in guids:
+        try:
+            score = int(reply[guid])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= score <= 100:
+            scores[guid] = score
+    return scores
+
 def clean_reply(s):
 
     matches = re.search(r'Score: (\d{1,3})', s)
@@ -105,83 +241,369 @@ def clean_reply(s):
         else:
             return "NA"
 
-def main(emb_path,obj_path):
-
-    output_prefix = os.path.basename(obj_path).replace("_learning_objectives.csv",'')
-
-    # load previous progress if exists
-    last_processed_index = -1
-    progress_file = f"{output_prefix}_progress.csv"
-
-    if os.path.exists(progress_file):
-        last_progress_df = pd.read_csv(progress_file)
-        if not last_progress_df.empty:
-            last_processed_index = last_progress_df.iloc[-1][0]
-
-    emb_df = load_emb(emb_path)
-    obj_df = load_emb(obj_path)
-
-    with open(f'{output_prefix}_cards.csv', 'a', newline='', encoding='utf-8') as csvfile:
-        csv_writer = csv.writer(csvfile)
-
-        if last_processed_index == -1:  # if there's no previous progress
-            csv_writer.writerow(['guid','card','tag','cosine_sim','gpt_reply','score','objective'])
-
-        for obj_index,obj_row in obj_df.iterrows():
-
-            if obj_index <= last_processed_index:
-                continue  # skip if the row has already been processed
-
-            print(f"Processing objective {obj_index}")
-            tag = obj_row['name']
-            obj = obj_row['learning_objective']
-            tokens = obj_row['tokens']
-            obj_emb = obj_row['emb']
+def use_structured_scoring():
+    return _scoring["structured"]
+
+def rate_card_legacy(prompt):
+    #try with progressively more creative juice
+    gpt_reply = "NA"
+    score = "NA"
+    temp = 0
+    calls = 0
+    while score == "NA" and temp <= 1:
+        gpt_reply = rate_card_for_obj(prompt, temperature=temp)
+        score = clean_reply(gpt_reply)
+        temp += 0.25
+        calls += 1
+    with _scoring_lock:
+        score_stats["legacy"] += 1
+        score_stats["legacy_retries"] += calls - 1
+        score_stats["legacy_unparsed"] += score == "NA"
+    return gpt_reply, score
+
+def rejects_response_format(error):
+    # only a 400 about response_format means the model has no structured outputs; a card that is too long
+    # or trips the content filter is that card's problem, not a reason to stop scoring the rest with JSON
+    return error.param == "response_format" or "response_format" in (error.code or "")
+
+def rate_card(obj, card):
+    if use_structured_scoring():
+        try:
+            gpt_reply = rate_card_structured(construct_prompt(obj, card, structured=True))
+        except openai.BadRequestError as e:
+            if not rejects_response_format(e):
+                raise
+            with _scoring_lock:
+                if _scoring["structured"]:
+                    print(f"Structured scoring not supported ({e}); falling back to free-text replies.")
+                _scoring["structured"] = False
+        else:
+            score = parse_structured_reply(gpt_reply)
+            with _scoring_lock:
+                score_stats["structured" if score != "NA" else "structured_unparsed"] += 1
+            if score != "NA":
+                return gpt_reply, score
+    return rate_card_legacy(construct_prompt(obj, card))
+
+def scoring_summary():
+    parts = []
+    if score_stats["structured"] or score_stats["structured_unparsed"]:
+        parts.append(f"{score_stats['structured']} structured replies "
+                     f"({score_stats['structured_unparsed']} unparseable, rescored as free text)")
+    if score_stats["legacy"]:
+        parts.append(f"{score_stats['legacy']} free-text replies needing {score_stats['legacy_retries']} retries "
+                     f"({score_stats['legacy_unparsed']} never parsed)")
+    return "Scoring: " + ("; ".join(parts) if parts else "no cards rated")
+
+def rate_batch(obj, batch):
+    """Score a list of (guid, card) against obj in one request; cards missing from the reply are asked again."""
+    scores = {}
+    remaining = batch
+    for attempt in range(BATCH_RETRIES + 1):
+        if len(remaining) == 1:
+            break
+        reply = rate_batch_for_obj(construct_batch_prompt(obj, remaining), len(remaining), temperature=0.25 * attempt)
+        scores.update(parse_batch_reply(reply, [guid for guid, _ in remaining]))
+        remaining = [(guid, card) for guid, card in remaining if guid not in scores]
+        if not remaining:
+            break
+
+    results = {guid: (f"Score: {score} (batch of {len(batch)})", score) for guid, score in scores.items()}
+    # whatever a batch still could not score is rated on its own
+    for guid, card in remaining:
+        results[guid] = rate_card(obj, card)
+    return [results[guid] for guid, _ in batch]
+
+def done_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+def rate_objective(obj, candidates, guids, cards, executor, window=RATING_WINDOW, batch_size=RATING_BATCH_SIZE, done=None):
+    """
+    Yield (card index, cosine sim, gpt reply, score) for one objective in ranking order, stopping exactly where
+    rating one request at a time would (MAX_POOR_MATCH_RUN / MAX_TOKENS_PER_OBJ). Each request scores
+    `batch_size` cards; up to `window` upcoming requests run concurrently and those past the stop point
+    are cancelled or discarded. Cards in `done` ({guid: (gpt reply, score)}, from the results store of an interrupted
+    run) are replayed instead of rated, so the stop rules land where they would have without spending anything.
+    """
+    done = done or {}
+    candidates = iter(candidates)
+    pending = deque()
+    ready = deque()
+    poor_match_run_count = 0
+    tokens_used = 0
+    tokens_submitted = 0
+    exhausted = False
 
-            emb_df["cosine_sim"] = emb_df.emb.apply(lambda x: vs(obj_emb,x))
-            emb_df.sort_values(by='cosine_sim', ascending=False, inplace=True)
+    try:
+        while True:
+            # Token spend only depends on the prompts, so a request is never submitted unless the
+            # sequential loop would reach it on budget; only the poor-match rule is speculated on.
+            while not exhausted and len(pending) < max(1, window) and tokens_submitted <= MAX_TOKENS_PER_OBJ:
+                unit = list(islice(candidates, max(1, batch_size)))
+                if not unit:
+                    exhausted = True
+                    break
+                unit_guids = [guids[card_index] for card_index, _ in unit]
+                if len(unit) == 1:
+                    card = cards[unit[0][0]]
+                    prompt = construct_prompt(obj, card, structured=use_structured_scoring())
+                else:
+                    batch = [(guids[card_index], cards[card_index]) for card_index, _ in unit]
+                    prompt = construct_batch_prompt(obj, batch)
+                if all(guid in done for guid in unit_guids):
+                    future = done_future([done[guid] for guid in unit_guids])
+                elif len(unit) == 1:
+                    future = executor.submit(lambda c: [rate_card(obj, c)], card)
+                else:
+                    future = executor.submit(rate_batch, obj, batch)
+                prompt_tokens = tokens_in_prompt(prompt)
+                tokens_submitted += prompt_tokens
+                pending.append((unit, prompt_tokens, future))
+
+            if poor_match_run_count > MAX_POOR_MATCH_RUN or tokens_used > MAX_TOKENS_PER_OBJ:
+                print(f"Tokens used: {tokens_used}")
+                break
+            if not ready:
+                if not pending:
+                    break
+                unit, prompt_tokens, future = pending.popleft()
+                tokens_used += prompt_tokens
+                ready.extend(zip(unit, future.result()))
+
+            (card_index, cosine_sim), (gpt_reply, score) = ready.popleft()
+            yield card_index, cosine_sim, gpt_reply, score
+
+            if score != "NA" and score > GOOD_MATCH_SCORE:
+                poor_match_run_count=0
+            else:
+                poor_match_run_count+=1
+    finally:
+        wasted = [future for *_, future in pending if not future.cancel()]
+        if wasted:
+            print(f"Discarded {len(wasted)} speculative ratings past the stop point")
+
+class ObjectiveState:
+    """Progress of one objective under the global scheduler."""
+
+    def __init__(self, lecture, obj_index, tag, obj, candidates, done=None):
+        self.lecture = lecture
+        self.done = done or {}  # stored ratings of an interrupted run, replayed instead of re-rated
+        self.obj_index = obj_index
+        self.tag = tag
+        self.obj = obj
+        self.candidates = iter(candidates)
+        self.next = next(self.candidates, None)
+        self.hit_rate = 0.5
+        self.poor_match_run_count = 0
+        self.tokens = 0
+        self.requests = 0
+        self.hits = 0
+        self.stopped = "" if self.next is not None else "no candidates"
+
+    def priority(self):
+        return self.next[1] + HIT_RATE_WEIGHT * (self.hit_rate - 0.5)
+
+    def take_next(self):
+        card_index, cosine_sim = self.next
+        self.next = next(self.candidates, None)
+        return card_index, cosine_sim
+
+    def record(self, score):
+        hit = score != "NA" and score > GOOD_MATCH_SCORE
+        self.hits += hit
+        self.hit_rate = HIT_RATE_DECAY * self.hit_rate + (1 - HIT_RATE_DECAY) * hit
+        self.poor_match_run_count = 0 if hit else self.poor_match_run_count + 1
+        if self.poor_match_run_count > MAX_POOR_MATCH_RUN:
+            self.stopped = "poor matches"
+        elif self.next is None:
+            self.stopped = "out of candidates"
+
+def lecture_prefix(obj_path):
+    return os.path.basename(obj_path).replace("_learning_objectives.csv",'')
+
+def write_spend_report(states, tokens_spent, token_budget, requests_sent):
+    report = pd.DataFrame([{
+        'lecture': state.lecture, 'objective_index': state.obj_index, 'tokens': state.tokens,
+        'requests': state.requests, 'hits': state.hits,
+        'hit_rate': round(state.hits / state.requests, 3) if state.requests else 0,
+        'stopped': state.stopped, 'objective': state.obj} for state in states])
+
+    print(f"Spent {tokens_spent} of {token_budget} tokens on {requests_sent} requests")
+    if report.empty:
+        return  # every objective was already finished in the results store
+    print(report.drop(columns=['objective']).to_string(index=False))
+    for lecture, lecture_report in report.groupby('lecture'):
+        lecture_report.to_csv(f"{lecture}_spend.csv", index=False)
+
+def load_deck(emb_path):
+    """Load the deck embeddings once, as (emb_df, card_matrix), for main() and run_global_schedule() to share."""
+    return load_embeddings(emb_path)
+
+def run_global_schedule(emb_path, obj_paths, exact=False, window=RATING_WINDOW, token_budget=None, request_budget=None, deck=None,
+                        results_path=DEFAULT_RESULTS_PATH, export_csv=False):
+    """
+    Rate cards for every objective in obj_paths from one priority queue and one budget (by default
+    MAX_TOKENS_PER_OBJ per objective, pooled). Stores the same ratings as main(), and writes
+    <lecture>_spend.csv with each objective's share of the spend.
+    """
+    with telemetry.stage("selection.load"):
+        emb_df, card_matrix = deck or load_deck(emb_path)
+        guids = emb_df['guid'].to_numpy()
+        cards = emb_df['card'].to_numpy()
+
+        states = []
+        lectures = []
+        store = ResultsStore(results_path)
+        for obj_path in obj_paths:
+            output_prefix = lecture_prefix(obj_path)
+            obj_df, obj_matrix = load_embeddings(obj_path)
+            if len(obj_df) == 0:
+                print(f"No learning objectives in {obj_path}")
+                continue
+            candidates = make_candidate_search(emb_path, card_matrix, obj_matrix, exact)
+            lectures.append(output_prefix)
+            for obj_index,obj_row in enumerate(obj_df.itertuples(index=False)):
+                obj = obj_row.learning_objective
+                if store.finished(output_prefix, obj_index, obj):
+                    continue
+                states.append(ObjectiveState(output_prefix, obj_index, obj_row.name, obj, candidates(obj_index),
+                                             store.resume(output_prefix, obj_index, obj)))
+
+    token_budget = token_budget or MAX_TOKENS_PER_OBJ * len(states)
+    # each objective has at most one entry: its next candidate, re-queued once the current one is rated
+    queue = [(-state.priority(), n, state) for n, state in enumerate(states) if not state.stopped]
+    heapq.heapify(queue)
+    sequence = len(states)
+    tokens_spent = 0
+    requests_sent = 0
+    # set once the best next prompt no longer fits; every objective still going then stops, the ones
+    # rated in the current wave included, so none spends past the point where a better one was cut off
+    budget_exhausted = False
 
-            poor_match_run_count = 0
-            tokens_used = 0
+    try:
+        with telemetry.stage("selection.rate"), ThreadPoolExecutor(max_workers=max(1, window)) as executor:
+            while queue:
+                wave = []
+                while queue and len(wave) < max(1, window):
+                    state = queue[0][2]
+                    card_index, _ = state.next
+                    prompt_tokens = tokens_in_prompt(construct_prompt(state.obj, cards[card_index], structured=use_structured_scoring()))
+                    if tokens_spent + prompt_tokens > token_budget or (request_budget and requests_sent >= request_budget):
+                        budget_exhausted = True
+                        for _, _, waiting in queue:
+                            waiting.stopped = "budget"
+                        queue = []
+                        break
+                    heapq.heappop(queue)
+                    card_index, cosine_sim = state.take_next()
+                    tokens_spent += prompt_tokens
+                    requests_sent += 1
+                    state.tokens += prompt_tokens
+                    state.requests += 1
+                    if guids[card_index] in state.done:
+                        future = done_future(state.done[guids[card_index]])
+                    else:
+                        future = executor.submit(rate_card, state.obj, cards[card_index])
+                    wave.append((state, card_index, cosine_sim, future))
+
+                for state, card_index, cosine_sim, future in wave:
+                    gpt_reply, score = future.result()
+                    store.add(state.lecture, state.obj_index, guids[card_index], cards[card_index],
+                                               state.tag, cosine_sim, gpt_reply, score, state.obj)
+                    state.record(score)
+                    if state.stopped:
+                        continue
+                    if budget_exhausted:
+                        state.stopped = "budget"
+                    else:
+                        heapq.heappush(queue, (-state.priority(), sequence, state))
+                        sequence += 1
+
+        for state in states:
+            # an objective cut off by the budget is left unfinished, so a rerun with a bigger one carries it on
+            if state.stopped != "budget":
+                store.finish_objective(state.lecture, state.obj_index, state.obj, state.stopped)
+    finally:
+        # after a crash too, so a rerun resumes after the cards rated so far
+        if export_csv:
+            for output_prefix in lectures:
+                store.export_csv(f"{output_prefix}_cards.csv", [output_prefix])
+        store.close()
+    write_spend_report(states, tokens_spent, token_budget, requests_sent)
+    print(scoring_summary())
+    if get_default_cache() is not None:
+        print(get_default_cache().summary())
+
+def main(emb_path,obj_path,exact=False,window=RATING_WINDOW,batch_size=RATING_BATCH_SIZE,deck=None,
+         results_path=DEFAULT_RESULTS_PATH,export_csv=False):
+
+    output_prefix = lecture_prefix(obj_path)
+
+    with telemetry.stage("selection.load"):
+        emb_df, card_matrix = deck or load_deck(emb_path)
+        obj_df, obj_matrix = load_embeddings(obj_path)
+        if len(obj_df) == 0:
+            # an empty store's matrix has no width to multiply the deck by
+            print(f"No learning objectives in {obj_path}")
+            return
+        candidates = make_candidate_search(emb_path, card_matrix, obj_matrix, exact)
+        guids = emb_df['guid'].to_numpy()
+        cards = emb_df['card'].to_numpy()
+
+    # ratings go to the results store as they come in; <lecture>_cards.csv is only written if asked for
+    store = ResultsStore(results_path)
+    try:
+        with telemetry.stage("selection.rate"), ThreadPoolExecutor(max_workers=max(1, window)) as executor:
+            for obj_index,obj_row in enumerate(obj_df.itertuples(index=False)):
+                tag = obj_row.name
+                obj = obj_row.learning_objective
 
-            for index,emb_row in emb_df.iterrows():
+                if store.finished(output_prefix, obj_index, obj):
+                    continue  # skip if the row has already been processed
 
-                if poor_match_run_count > MAX_POOR_MATCH_RUN or tokens_used > MAX_TOKENS_PER_OBJ:
-                    print(f"Tokens used: {tokens_used}")
-                    break
+                done = store.resume(output_prefix, obj_index, obj)
+                print(f"Processing objective {obj_index}" + (f" (resuming after {len(done)} stored ratings)" if done else ""))
 
-                guid = emb_row['guid']
-                card = emb_row['card']
-                cosine_sim = emb_row["cosine_sim"]
-                gpt_reply = "NA"
-                score = "NA"
-
-                prompt = construct_prompt(obj,card)
-                tokens_used += tokens_in_prompt(prompt)
-                #print(f"Poor matches: {poor_match_run_count}")
-
-                #try with progressively more creative juice
-                temp = 0
-                while score == "NA" and temp <= 1:
-                    gpt_reply = rate_card_for_obj(prompt, temperature=temp)
-                    score = clean_reply(gpt_reply)
-                    temp += 0.25
-
-                csv_writer.writerow([guid,card,tag,cosine_sim,gpt_reply,score,obj])
-                if score > 50:
-                    poor_match_run_count=0
-                else:
-                    poor_match_run_count+=1
+                for card_index, cosine_sim, gpt_reply, score in rate_objective(obj, candidates(obj_index), guids, cards, executor, window, batch_size, done):
+                    store.add(output_prefix, obj_index, guids[card_index], cards[card_index], tag, cosine_sim, gpt_reply, score, obj)
+                store.finish_objective(output_prefix, obj_index, obj)
+    finally:
+        if export_csv:
+            store.export_csv(f'{output_prefix}_cards.csv', [output_prefix])
+        store.close()
 
-            with open(progress_file, 'a', newline='', encoding='utf-8') as progress_csvfile:
-                progress_csv_writer = csv.writer(progress_csvfile)
-                progress_csv_writer.writerow([obj_index])
+    print(scoring_summary())
+    if get_default_cache() is not None:
+        print(get_default_cache().summary())
 
 if __name__ == "__main__":
     set_api_key()
-    if len(sys.argv) != 3:
-        print("Usage: select_cards.py <deck_embeding> <learning_objectives>")
-        sys.exit(1)
-    emb_path = sys.argv[1]
-    obj_path = sys.argv[2]
-    main(emb_path,obj_path)
+    parser = argparse.ArgumentParser(usage="select_cards.py <deck_embeding> <learning_objectives> [<learning_objectives> ...] [options]")
+    parser.add_argument("emb_path")
+    parser.add_argument("obj_paths", nargs="+")
+    parser.add_argument("--exact", action="store_true", help="Ignore an ANN index built next to the deck embeddings")
+    parser.add_argument("--window", type=int, default=RATING_WINDOW, help="Requests in flight ahead of the stop rules (1 = one at a time)")
+    parser.add_argument("--batch", type=int, default=RATING_BATCH_SIZE, help="Cards scored per request (1 = one prompt per card)")
+    parser.add_argument("--scoring", choices=["structured", "legacy"], default=SCORING_MODE,
+                        help="JSON-schema replies with a tight token cap, or free text scraped with retries")
+    parser.add_argument("--scheduler", choices=["objective", "global"], default="objective",
+                        help="objective: each objective in turn with its own MAX_TOKENS_PER_OBJ budget. "
+                             "global: one priority queue and budget across all objectives of all given lectures")
+    parser.add_argument("--budget", type=int, default=None, help="Global scheduler token budget (default MAX_TOKENS_PER_OBJ per objective)")
+    parser.add_argument("--max-requests", type=int, default=None, help="Global scheduler request budget")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_PATH, help="SQLite store the ratings of every lecture go to")
+    parser.add_argument("--export-csv", action="store_true", help="Also write each lecture's ratings to <lecture>_cards.csv")
+    parser.add_argument("--profile", action="store_true", help="Write a cProfile of the run to Data/telemetry")
+    args = parser.parse_args()
+    if args.scheduler == "global" and args.batch != RATING_BATCH_SIZE:
+        parser.error("--batch only applies to --scheduler objective; the global scheduler rates one card per request")
+    _scoring["structured"] = args.scoring == "structured"
+    with telemetry.run("selection", args.profile):
+        if args.scheduler == "global":
+            run_global_schedule(args.emb_path,args.obj_paths,args.exact,args.window,args.budget,args.max_requests,
+                                results_path=args.results,export_csv=args.export_csv)
+        else:
+            for obj_path in args.obj_paths:
+                main(args.emb_path,obj_path,args.exact,args.window,args.batch,results_path=args.results,export_csv=args.export_csv)
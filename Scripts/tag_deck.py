@@ -1,90 +1,128 @@
-import os, sys
-import shutil
-import zipfile
+import time
+import argparse
 import pandas as pd
-from anki.collection import Collection
-    #python3 Scripts/tag_deck.py learning_guide_cards.csv anki_deck.apkg
+from util.apkg import edit_collection
+from util.results_store import ResultsStore
+from util import telemetry
+    #python3 Scripts/tag_deck.py Data/results.sqlite anki_deck.apkg
+    #python3 Scripts/tag_deck.py Data/results.sqlite anki_deck.apkg --lecture lecture1 lecture2
+    #python3 Scripts/tag_deck.py Merged.csv anki_deck.apkg
 
 HIGH_RELEVANCE_CUTOFF = 70
 MEDIUM_RELEVANCE_CUTOFF = 50
 REMOVE_RELEVANCE_CUTOFF = 40
+RELEVANCE_TIERS = [(HIGH_RELEVANCE_CUTOFF, "1_highly_relevant"),
+                   (MEDIUM_RELEVANCE_CUTOFF, "2_somewhat_relevant"),
+                   (REMOVE_RELEVANCE_CUTOFF, "3_minimally_relevant")]
+UNMATCHED_SHOWN = 20
+
+def relevance_tag(tag, score):
+    """<tag>::<tier> for the highest tier score reaches, or None below REMOVE_RELEVANCE_CUTOFF."""
+    for cutoff, tier in RELEVANCE_TIERS:
+        if score >= cutoff:
+            return f"{tag}::{tier}"
+    return None
+
+def merge_tags(note_tags, new_tags):
+    """
+    Return the note's tag string with new_tags added. A lecture's earlier relevance tag is replaced rather
+    than kept alongside the new one, and tags are deduplicated (case-insensitively, as Anki compares them).
+    """
+    replaced = {f"{tag.rsplit('::', 1)[0]}::{tier}".casefold() for tag in new_tags for _, tier in RELEVANCE_TIERS}
+    tags = [t for t in note_tags.split() if t.casefold() not in replaced] + new_tags
+    unique = {}
+    for t in tags:
+        unique.setdefault(t.casefold(), t)
+    return " " + " ".join(unique.values()) + " "
+
+def apply_tags(col, df):
+    """
+    Tag every note in df (guid, tag, score) in one pass: one query maps all guids to notes, the new tag
+    strings are built in memory, and the changed notes are written with a single executemany.
+    Returns (tagged guids, unmatched rows).
+    """
+    notes = {guid: (note_id, tags) for note_id, guid, tags in col.db.all("SELECT id, guid, tags FROM notes")}
+
+    new_tags = {}
+    unmatched = []
+    for guid, tag, score, card in zip(df['guid'], df['tag'], df['score'].astype(int), df['card']):
+        relevance = relevance_tag(tag, score)
+        if relevance is None:
+            continue
+        if guid not in notes:
+            unmatched.append((guid, card))
+            continue
+        new_tags.setdefault(guid, []).append(relevance)
+
+    mod = int(time.time())
+    updates = []
+    for guid, tags in new_tags.items():
+        note_id, note_tags = notes[guid]
+        merged = merge_tags(note_tags, tags)
+        if merged != note_tags:
+            # usn -1 marks the note as changed for the next sync
+            updates.append((merged, mod, note_id))
+    col.db.executemany("UPDATE notes SET tags = ?, mod = ?, usn = -1 WHERE id = ?", updates)
+    print(f"Updated tags of {len(updates)} notes ({len(new_tags) - len(updates)} already tagged)")
+    return set(new_tags), unmatched
+
+def report_unmatched(unmatched):
+    if not unmatched:
+        return
+    print(f"{len(unmatched)} cards were not found in the deck by guid:")
+    for guid, card in unmatched[:UNMATCHED_SHOWN]:
+        print(f"  {guid}: {str(card)[:80]}")
+    if len(unmatched) > UNMATCHED_SHOWN:
+        print(f"  ... and {len(unmatched) - UNMATCHED_SHOWN} more")
+
+def load_best_scores(card_path, lectures=None):
+    """
+    The highest-scored rating of each guid as a DataFrame (guid, tag, score, card), from the results store
+    (optionally only these lectures), or from a cards CSV such as an exported Merged.csv.
+    """
+    if not card_path.endswith(".csv"):
+        store = ResultsStore(card_path)
+        try:
+            return pd.DataFrame(store.best_scores(lectures), columns=['guid', 'tag', 'score', 'card'])
+        finally:
+            store.close()
 
-def main(card_path, anki_apkg):
-
-    # Load the csv file into a DataFrame
     df = pd.read_csv(card_path)
     df = df.fillna(0)
+    # Group by 'guid' and keep only the row with the highest 'score' for each group
+    return df.loc[df.groupby('guid')['score'].idxmax()]
+
+def main(card_path, anki_apkg, lectures=None):
+
+    with telemetry.stage("tag.read_results"):
+        df = load_best_scores(card_path, lectures)
 
     pd.set_option('display.max_columns', None)
     pd.set_option('display.max_rows', None)
 
-    # Group by 'guid' and keep only the row with the highest 'score' for each group
-    df = df.loc[df.groupby('guid')['score'].idxmax()]
-
-    # Unzip the .apkg file to a temporary folder
-    with zipfile.ZipFile(anki_apkg, 'r') as zip_ref:
-        zip_ref.extractall("temp_folder")
-
-    # The main .anki2 database file should have been extracted now
-    # Look for the .anki21 file in the temp_folder
-    anki2_file = [f for f in os.listdir("temp_folder") if f.endswith(".anki21")][0]
-
-    # Initialize a new collection
-    col = Collection(os.path.join("temp_folder", anki2_file))
-    tagged = set()
-
-    # Iterate through all cards
-    # For each row in the DataFrame
-
-    for index, row in df.iterrows():
-
-        guid = row['guid']
-        tag = row['tag']
-        score = int(row['score'])
-
-        if score >= HIGH_RELEVANCE_CUTOFF:
-            try:
-                note_id,note_tags = col.db.all("SELECT id, tags FROM notes WHERE guid = ?",guid)[0]
-                new_tag = note_tags + " " + tag+"::1_highly_relevant" + " "
-                col.db.execute("UPDATE notes set tags = ? where id = ?", new_tag, note_id)
-                tagged.add(guid)
-            except:
-                print(f"guid not found for card: {row['card']}")
-
-        if score < HIGH_RELEVANCE_CUTOFF and score >= MEDIUM_RELEVANCE_CUTOFF:
-            try:
-                note_id,note_tags = col.db.all("SELECT id, tags FROM notes WHERE guid = ?",guid)[0]
-                new_tag = note_tags + " " + tag+"::2_somewhat_relevant" + " "
-                col.db.execute("UPDATE notes set tags = ? where id = ?", new_tag, note_id)
-                tagged.add(guid)
-            except:
-                print(f"guid not found for card: {row['card']}")
-
-        if score < MEDIUM_RELEVANCE_CUTOFF and score >= REMOVE_RELEVANCE_CUTOFF:
-            try:
-                note_id,note_tags = col.db.all("SELECT id, tags FROM notes WHERE guid = ?",guid)[0]
-                new_tag = note_tags + " " + tag+"::3_minimally_relevant" + " "
-                col.db.execute("UPDATE notes set tags = ? where id = ?", new_tag, note_id)
-                tagged.add(guid)
-            except:
-                print(f"guid not found for card: {row['card']}")
-
-    # Save the collection
-    col.close()
-
-    # Re-create the .apkg file
-    with zipfile.ZipFile(anki_apkg, 'w') as zip_ref:
-        for filename in os.listdir("temp_folder"):
-            zip_ref.write(os.path.join("temp_folder", filename), arcname=filename)
-
-    # Clean up the temporary folder
+    # Only the collection database is extracted, into a private temporary folder; the media is
+    # copied into the rewritten .apkg as is
+    # anki is imported here, so the rest of this module (apply_tags for the benchmarks) works without it
+    from anki.collection import Collection
+
+    with telemetry.stage("tag.deck"), edit_collection(anki_apkg) as collection_path:
+        col = Collection(collection_path)
+        try:
+            with telemetry.stage("tag.apply"):
+                tagged, unmatched = apply_tags(col, df)
+        finally:
+            # Save the collection
+            col.close()
+    report_unmatched(unmatched)
+
     print(f"Tagged {len(tagged)} cards. Process Complete")
-    shutil.rmtree("temp_folder")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: tag_deck.py <cards.csv> <anki_deck.apkg>")
-        sys.exit(1)
-    card_path = sys.argv[1]
-    anki_apkg = sys.argv[2]
-    main(card_path, anki_apkg)
+    parser = argparse.ArgumentParser(usage="tag_deck.py <results.sqlite | cards.csv> <anki_deck.apkg> [--lecture ...]")
+    parser.add_argument("card_path", help="The results store select_cards writes to, or a cards CSV")
+    parser.add_argument("anki_apkg")
+    parser.add_argument("--lecture", nargs="+", default=None, help="Only tag with these lectures' ratings (default all in the store)")
+    args = parser.parse_args()
+    # set ANKI_TAGGER_PROFILE=tag to profile the run
+    with telemetry.run("tag"):
+        main(args.card_path, args.anki_apkg, args.lecture)
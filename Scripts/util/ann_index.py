@@ -0,0 +1,120 @@
+import os
+import hashlib
+
+import numpy as np
+
+from util.embeddings_utils import normalize_rows, top_k_indices
+
+# Inverted-file (IVF) index: the deck is clustered with spherical k-means, each card lives in the
+# list of its nearest centroid, and a query only scores the cards in its n_probe closest lists.
+
+DEFAULT_N_PROBE = 16
+KMEANS_ITERATIONS = 20
+KMEANS_SAMPLE = 30000
+ASSIGN_CHUNK = 8192
+
+
+def index_path(emb_path):
+    return os.path.splitext(emb_path)[0] + ".ivf.npz"
+
+
+def default_n_lists(n_vectors):
+    return max(1, int(2 * np.sqrt(n_vectors)))
+
+
+def matrix_fingerprint(matrix):
+    # cheap check that an index still belongs to the embeddings next to it
+    step = max(1, len(matrix) // 64)
+    digest = hashlib.sha1(np.ascontiguousarray(matrix[::step]).tobytes())
+    digest.update(str(matrix.shape).encode())
+    return digest.hexdigest()
+
+
+def assign_to_centroids(matrix, centroids):
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), ASSIGN_CHUNK):
+        chunk = normalize_rows(matrix[start:start + ASSIGN_CHUNK])
+        assignments[start:start + ASSIGN_CHUNK] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(matrix, n_lists, n_iter=KMEANS_ITERATIONS, sample=KMEANS_SAMPLE, seed=0):
+    rng = np.random.default_rng(seed)
+    if len(matrix) > sample:
+        matrix = matrix[np.sort(rng.choice(len(matrix), sample, replace=False))]
+    matrix = normalize_rows(matrix)
+    centroids = matrix[rng.choice(len(matrix), n_lists, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = assign_to_centroids(matrix, centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        empty = counts == 0
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(matrix[order], starts[~empty])
+        # re-seed empty lists with random points so every list stays in use
+        sums[empty] = matrix[rng.choice(len(matrix), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+
+    def __init__(self, centroids, order, offsets, fingerprint, n_probe=DEFAULT_N_PROBE):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.fingerprint = fingerprint
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, matrix, n_lists=None, n_probe=DEFAULT_N_PROBE, seed=0):
+        n_lists = min(n_lists or default_n_lists(len(matrix)), len(matrix))
+        centroids = spherical_kmeans(matrix, n_lists, seed=seed)
+        assignments = assign_to_centroids(matrix, centroids)
+        order = np.argsort(assignments, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))]).astype(np.int64)
+        return cls(centroids, order, offsets, matrix_fingerprint(matrix), n_probe)
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                     fingerprint=self.fingerprint, n_probe=self.n_probe)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["order"], data["offsets"], str(data["fingerprint"]), int(data["n_probe"]))
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def candidates(self, query, n_probe=None):
+        """Card indices in the n_probe lists closest to query."""
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        lists = top_k_indices(self.centroids @ query, n_probe)
+        return np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+
+    def search(self, matrix, query, k, n_probe=None):
+        """Return (card indices, cosine similarities) of the approximate top k, highest first."""
+        query = normalize_rows(query)
+        # sorted so rows are read from a memory-mapped matrix in file order
+        candidates = np.sort(self.candidates(query, n_probe))
+        scores = normalize_rows(matrix[candidates]) @ query
+        top = top_k_indices(scores, k)
+        return candidates[top], scores[top]
+
+
+def load_index(emb_path, matrix):
+    """Return the index persisted next to emb_path, or None if there is none or it is out of date."""
+    path = index_path(emb_path)
+    if not os.path.exists(path):
+        return None
+    index = IVFIndex.load(path)
+    if index.fingerprint != matrix_fingerprint(matrix):
+        print(f"ANN index {path} was built from different embeddings; rebuild it with build_ann_index.py. Using exact search.")
+        return None
+    return index
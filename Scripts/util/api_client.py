@@ -0,0 +1,171 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+import openai
+from openai import OpenAI
+
+from util import rate_limit, telemetry
+
+# The one way every script reaches the OpenAI API. Each request takes its share of the requests- and
+# tokens-per-minute buckets first. Failures are retried with capped, jittered exponential backoff that
+# honours Retry-After, up to MAX_RETRIES times; a 429 also pauses the shared limiter, so every worker backs off.
+# After BREAKER_THRESHOLD consecutive server or connection failures the circuit breaker opens and calls fail
+# fast for BREAKER_COOLDOWN seconds instead of piling onto a struggling API.
+MAX_RETRIES = 6
+MAX_RETRY_SECONDS = 300  # give up once a single call has spent this long retrying
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+RETRY_AFTER_CAP = 120.0
+BREAKER_THRESHOLD = 8
+BREAKER_COOLDOWN = 30.0
+RETRY_STATUS = (408, 409, 429)  # and every 5xx; other 4xx errors are the request's fault and are raised at once
+
+
+class RetryBudgetExceeded(RuntimeError):
+    pass
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError while open; after the cooldown, let one trial call through."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial_running:
+                raise CircuitOpenError(f"OpenAI API failed {self.failures} times in a row; "
+                                       f"not sending requests for {self.cooldown:.0f}s")
+            self.trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                if self.opened_at is None or self.trial_running:
+                    print(f"Circuit breaker open after {self.failures} consecutive API failures")
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+_client = None
+_breaker = CircuitBreaker()
+_setup_lock = threading.Lock()
+
+
+def get_client():
+    """The shared OpenAI client; its own retries are off, so request() is the only retry loop."""
+    global _client
+    with _setup_lock:
+        if _client is None:
+            _client = OpenAI(max_retries=0)
+        if rate_limit.get_limiter() is None:
+            rate_limit.set_limiter(rate_limit.RateLimiter())
+    return _client
+
+
+def is_retryable(error):
+    if isinstance(error, openai.APIConnectionError):  # includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRY_STATUS or error.status_code >= 500
+    return False
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait, from retry-after-ms or retry-after, or None."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def backoff_delay(attempt, asked=None):
+    if asked is not None and asked > 0:
+        # the server knows when capacity is back; a little jitter spreads the retries out
+        return min(asked, RETRY_AFTER_CAP) * random.uniform(1, 1.25)
+    # full jitter keeps workers that failed together from retrying together
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def request(kind, create, tokens, params):
+    """
+    Call create(**params) (a with_raw_response method) with rate limiting, retries and the circuit breaker.
+    Returns (parsed response, seconds taken including retries). Errors that can't be fixed by retrying are
+    raised as they are; retryable ones raise RetryBudgetExceeded once MAX_RETRIES or MAX_RETRY_SECONDS is used up.
+    """
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        _breaker.before_call()
+        rate_limit.acquire(tokens)
+        try:
+            response = create(**params).parse()
+        except openai.APIError as e:
+            if not is_retryable(e):
+                _breaker.record_success()  # the API answered; the request itself is wrong
+                raise
+            if not isinstance(e, openai.RateLimitError):
+                _breaker.record_failure()  # a 429 means the API is up, just busy
+            elapsed = time.perf_counter() - start
+            if attempt >= MAX_RETRIES or elapsed >= MAX_RETRY_SECONDS:
+                raise RetryBudgetExceeded(f"{kind} request failed {attempt + 1} times over {elapsed:.0f}s: {e}") from e
+            asked = retry_after(e)
+            delay = backoff_delay(attempt, asked)
+            if isinstance(e, openai.RateLimitError):
+                rate_limit.pause(min(asked, RETRY_AFTER_CAP) if asked else delay)
+            print(f"{type(e).__name__} on {kind} request, retry {attempt + 1}/{MAX_RETRIES} in {delay:.1f}s")
+            telemetry.record_retry(kind)
+            time.sleep(delay)
+            attempt += 1
+            continue
+        _breaker.record_success()
+        return response, time.perf_counter() - start
+
+
+def create_chat_completion(**params):
+    tokens = rate_limit.estimate_tokens(params.get("messages", "")) + params.get("max_tokens", 0)
+    completion, seconds = request("chat", get_client().chat.completions.with_raw_response.create, tokens, params)
+    usage = completion.usage
+    telemetry.record_call("chat", seconds, params.get("model", ""),
+                          usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0)
+    return completion
+
+
+def create_embeddings(**params):
+    texts = params["input"] if isinstance(params["input"], list) else [params["input"]]
+    tokens = sum(map(rate_limit.estimate_tokens, texts))
+    response, seconds = request("embeddings", get_client().embeddings.with_raw_response.create, tokens, params)
+    telemetry.record_call("embeddings", seconds, params["model"], response.usage.prompt_tokens if response.usage else 0)
+    return response
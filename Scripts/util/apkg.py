@@ -0,0 +1,142 @@
+import os
+import copy
+import shutil
+import struct
+import zipfile
+import tempfile
+from contextlib import contextmanager
+
+# An .apkg is a zip holding the collection database next to the media. Only the database is ever
+# extracted; media and every other member are copied into the rewritten archive as raw compressed bytes.
+COLLECTION_MEMBERS = ("collection.anki21b", "collection.anki21", "collection.anki2")  # newest format first
+COPY_CHUNK = 1 << 20
+# copy_member_raw works on zipfile's undocumented internals. If a Python release drops any of them, every
+# member is decompressed and recompressed instead, which is slower but produces the same archive contents.
+RAW_COPY_NAMES = ("structFileHeader", "sizeFileHeader", "_FH_FILENAME_LENGTH", "_FH_EXTRA_FIELD_LENGTH",
+                  "_MASK_USE_DATA_DESCRIPTOR", "_strip_extra")
+RAW_COPY_ZIPFILE_ATTRS = ("fp", "filelist", "NameToInfo", "start_dir")
+RAW_COPY = all(hasattr(zipfile, name) for name in RAW_COPY_NAMES) and hasattr(zipfile.ZipInfo, "FileHeader")
+
+
+def collection_member(zf):
+    names = set(zf.namelist())
+    for member in COLLECTION_MEMBERS:
+        if member in names:
+            return member
+    raise ValueError(f"{zf.filename} has no collection database ({', '.join(COLLECTION_MEMBERS)})")
+
+
+def zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("collection.anki21b decks are zstd-compressed; install zstandard (pip install zstandard)")
+    return zstandard
+
+
+def extract_collection(zf, member, folder):
+    """Write member, decompressed to a plain SQLite file, into folder and return its path."""
+    path = os.path.join(folder, member.rstrip("b"))
+    with zf.open(member) as src, open(path, "wb") as dst:
+        if member.endswith("b"):
+            zstandard().ZstdDecompressor().copy_stream(src, dst)
+        else:
+            shutil.copyfileobj(src, dst, COPY_CHUNK)
+    return path
+
+
+def copy_member_raw(zin, zout, info):
+    """Append info's compressed bytes from zin to zout without decompressing them."""
+    zin.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader))
+    zin.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    new_info = copy.copy(info)
+    # sizes and CRC are known from the central directory, so they go in the local header instead of a data
+    # descriptor, and FileHeader adds a fresh zip64 field when one is needed
+    new_info.flag_bits &= ~zipfile._MASK_USE_DATA_DESCRIPTOR
+    new_info.extra = zipfile._strip_extra(info.extra, (1,))
+    new_info.header_offset = zout.fp.tell()
+    zout.fp.write(new_info.FileHeader())
+
+    remaining = info.compress_size
+    while remaining:
+        chunk = zin.fp.read(min(COPY_CHUNK, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"{info.filename} is truncated")
+        zout.fp.write(chunk)
+        remaining -= len(chunk)
+
+    zout.filelist.append(new_info)
+    zout.NameToInfo[new_info.filename] = new_info
+    zout.start_dir = zout.fp.tell()
+
+
+def copy_member(zin, zout, info):
+    """Append info from zin to zout through the public API, decompressing and recompressing it."""
+    # a copy, since writestr fills in sizes and offsets of the info it is given
+    zout.writestr(copy.copy(info), zin.read(info))
+
+
+def write_collection(zout, member, db_path):
+    if member.endswith("b"):
+        # already zstd-compressed, so stored as is
+        info = zipfile.ZipInfo(member, date_time=zipfile.ZipInfo.from_file(db_path).date_time)
+        with open(db_path, "rb") as src, zout.open(info, "w", force_zip64=True) as dst:
+            zstandard().ZstdCompressor().copy_stream(src, dst)
+    else:
+        zout.write(db_path, arcname=member, compress_type=zipfile.ZIP_DEFLATED)
+
+
+def rewrite_apkg(apkg_path, member, db_path):
+    """
+    Replace apkg_path atomically with a copy whose collection is db_path. Other members are copied raw, or
+    recompressed if this Python's zipfile lacks what copy_member_raw needs.
+    """
+    folder = os.path.dirname(os.path.abspath(apkg_path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".apkg.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f, zipfile.ZipFile(apkg_path) as zin, zipfile.ZipFile(f, "w") as zout:
+            # checked before anything is written, so a missing internal never leaves a half-copied deck
+            raw = RAW_COPY and all(hasattr(zout, attr) for attr in RAW_COPY_ZIPFILE_ATTRS)
+            for info in zin.infolist():
+                if info.filename == member:
+                    write_collection(zout, member, db_path)
+                elif raw:
+                    copy_member_raw(zin, zout, info)
+                else:
+                    copy_member(zin, zout, info)
+        shutil.copymode(apkg_path, tmp_path)
+        os.replace(tmp_path, apkg_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def read_collection(apkg_path):
+    """Yield the path of a private, temporary copy of the .apkg's collection database."""
+    folder = tempfile.mkdtemp(prefix="anki_tagger_")
+    try:
+        with zipfile.ZipFile(apkg_path) as zf:
+            db_path = extract_collection(zf, collection_member(zf), folder)
+        yield db_path
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+@contextmanager
+def edit_collection(apkg_path):
+    """
+    Yield the path of a private copy of the .apkg's collection database. If the block finishes without
+    an error, the (closed) database is written back and the .apkg is replaced atomically.
+    """
+    folder = tempfile.mkdtemp(prefix="anki_tagger_")
+    try:
+        with zipfile.ZipFile(apkg_path) as zf:
+            member = collection_member(zf)
+            db_path = extract_collection(zf, member, folder)
+        yield db_path
+        rewrite_apkg(apkg_path, member, db_path)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
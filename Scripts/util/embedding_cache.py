@@ -0,0 +1,123 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+# One cache for every deck and script, so an identical string is only ever embedded once per model.
+DEFAULT_CACHE_PATH = os.path.join("Data", "embedding_cache.sqlite")
+DEFAULT_MAX_ENTRIES = 500000
+SQLITE_MAX_VARS = 900
+
+
+def normalize_text(text):
+    # get_embedding(s) already swaps newlines for spaces; collapse the rest of the whitespace too.
+    return " ".join(text.split())
+
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent (model, text hash) -> embedding store with least-recently-used eviction."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings ("
+                           "model TEXT NOT NULL, key TEXT NOT NULL, emb BLOB NOT NULL, last_used REAL NOT NULL, "
+                           "PRIMARY KEY (model, key))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, texts, model):
+        """Return a list aligned with texts holding the cached embedding, or None on a miss."""
+        keys = [text_key(text) for text in texts]
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique_keys), SQLITE_MAX_VARS):
+                chunk = unique_keys[i:i + SQLITE_MAX_VARS]
+                rows = self._conn.execute(
+                    f"SELECT key, emb FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [model, *chunk]).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?",
+                                       [(now, model, key) for key in found])
+                self._conn.commit()
+
+        results = [np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None for key in keys]
+        n_hits = sum(result is not None for result in results)
+        self.hits += n_hits
+        self.misses += len(results) - n_hits
+        return results
+
+    def put_many(self, texts, embeddings, model):
+        now = time.time()
+        rows = [(model, text_key(text), np.asarray(emb, dtype=np.float32).tobytes(), now)
+                for text, emb in zip(texts, embeddings)]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (model, key, emb, last_used) VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Drop the least recently used entries once the cache grows past max_entries."""
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                self._conn.execute("DELETE FROM embeddings WHERE rowid IN "
+                                   "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (excess,))
+                self._conn.commit()
+            return max(excess, 0)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def embed_with_cache(texts, model, embed_fn, cache):
+    """
+    Return embeddings for texts, taking hits from the cache and calling embed_fn(list_of_texts)
+    once for the misses. Strings that normalize to the same key are only embedded once.
+    """
+    embeddings = cache.get_many(texts, model)
+    missing = {}
+    for text, emb in zip(texts, embeddings):
+        if emb is None:
+            missing.setdefault(text_key(text), text)
+
+    if missing:
+        missing_texts = list(missing.values())
+        new_embeddings = embed_fn(missing_texts)
+        cache.put_many(missing_texts, new_embeddings, model)
+        fresh = dict(zip(missing.keys(), new_embeddings))
+        embeddings = [emb if emb is not None else fresh[text_key(text)] for text, emb in zip(texts, embeddings)]
+
+    return embeddings
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    global _default_cache
+    # called from embedding worker threads, which must all share one cache and its connection
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache(os.environ.get("ANKI_TAGGER_EMBEDDING_CACHE", DEFAULT_CACHE_PATH))
+    return _default_cache
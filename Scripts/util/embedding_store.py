@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# An embedding store is two files sharing a prefix:
+#   <name>.csv  compact metadata table (guid/card/tokens, or name/learning_objective/tokens), one row per vector
+#   <name>.npy  contiguous float32 matrix, row i belongs to metadata row i, memory-mappable with np.load
+# Older files kept each embedding as a stringified list in an 'emb' column of <name>.csv instead.
+
+EMB_DTYPE = np.float32
+# text columns that pandas must not coerce (eg. an all-digit guid)
+TEXT_DTYPES = {"guid": str, "card": str, "name": str, "learning_objective": str}
+
+
+def matrix_path(path):
+    return os.path.splitext(path)[0] + ".npy"
+
+
+def is_legacy_csv(path):
+    header = pd.read_csv(path, nrows=0).columns
+    return "emb" in header
+
+
+def store_exists(path):
+    return os.path.exists(path) and (os.path.exists(matrix_path(path)) or is_legacy_csv(path))
+
+
+def save_store(meta_df, embeddings, path):
+    """Write metadata and a float32 matrix, replacing any previous store at path atomically per file."""
+    matrix = np.ascontiguousarray(np.asarray(embeddings, dtype=EMB_DTYPE))
+    if matrix.size == 0:
+        matrix = matrix.reshape(0, matrix.shape[-1] if matrix.ndim == 2 else 0)
+    if len(matrix) != len(meta_df):
+        raise ValueError(f"{len(meta_df)} metadata rows but {len(matrix)} embeddings")
+
+    meta_df = meta_df.drop(columns=["emb"], errors="ignore")
+    npy_file = matrix_path(path)
+    with open(npy_file + ".tmp", "wb") as f:
+        np.save(f, matrix)
+    meta_df.to_csv(path + ".tmp", index=False)
+    os.replace(npy_file + ".tmp", npy_file)
+    os.replace(path + ".tmp", path)
+
+
+def load_store(path, mmap=True):
+    meta_df = pd.read_csv(path, dtype=TEXT_DTYPES)
+    matrix = np.load(matrix_path(path), mmap_mode="r" if mmap else None)
+    if len(matrix) != len(meta_df):
+        raise ValueError(f"{path} has {len(meta_df)} rows but {matrix_path(path)} has {len(matrix)}; re-create the store")
+    return meta_df, matrix
+
+
+def load_legacy_csv(path):
+    """Parse a CSV with stringified-list embeddings into (metadata, float32 matrix)."""
+    df = pd.read_csv(path, dtype=TEXT_DTYPES, converters={"emb": lambda s: np.fromstring(s.strip("[]"), sep=",", dtype=EMB_DTYPE)})
+    matrix = np.vstack(df.emb.values) if len(df) else np.empty((0, 0), dtype=EMB_DTYPE)
+    return df.drop(columns=["emb"]), matrix
+
+
+def load_embeddings(path, mmap=True):
+    """Return (metadata, matrix) from either a binary store or a legacy CSV."""
+    if os.path.exists(matrix_path(path)) and not is_legacy_csv(path):
+        return load_store(path, mmap=mmap)
+    return load_legacy_csv(path)
+
+
+def legacy_backup_path(path):
+    return os.path.splitext(path)[0] + ".legacy.csv"
+
+
+def convert_csv(path):
+    """One-time conversion of a legacy CSV into a binary store. The original is kept as <name>.legacy.csv."""
+    if not is_legacy_csv(path):
+        print(f"{path} is already a binary store")
+        return
+    meta_df, matrix = load_legacy_csv(path)
+    backup = legacy_backup_path(path)
+    os.replace(path, backup)
+    save_store(meta_df, matrix, path)
+    print(f"Converted {path}: {len(meta_df)} rows x {matrix.shape[1]} dims (original kept at {backup})")
@@ -3,66 +3,15 @@ from typing import List, Optional
 
 import matplotlib.pyplot as plt
 import plotly.express as px
-from scipy import spatial
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 from sklearn.metrics import average_precision_score, precision_recall_curve
 
-from openai import OpenAI
 import numpy as np
 import pandas as pd
 
-client = OpenAI(max_retries=5)
-
-
-def get_embedding(text: str, model="text-embedding-3-small", **kwargs) -> List[float]:
-    # replace newlines, which can negatively affect performance.
-    text = text.replace("\n", " ")
-
-    response = client.embeddings.create(input=[text], model=model, **kwargs)
-
-    return response.data[0].embedding
-
-
-async def aget_embedding(
-    text: str, model="text-embedding-3-small", **kwargs
-) -> List[float]:
-    # replace newlines, which can negatively affect performance.
-    text = text.replace("\n", " ")
-
-    return (await client.embeddings.create(input=[text], model=model, **kwargs))[
-        "data"
-    ][0]["embedding"]
-
-
-def get_embeddings(
-    list_of_text: List[str], model="text-embedding-3-small", **kwargs
-) -> List[List[float]]:
-    assert len(list_of_text) <= 2048, "The batch size should not be larger than 2048."
-
-    # replace newlines, which can negatively affect performance.
-    list_of_text = [text.replace("\n", " ") for text in list_of_text]
-
-    data = client.embeddings.create(input=list_of_text, model=model, **kwargs).data
-    return [d.embedding for d in data]
-
-
-async def aget_embeddings(
-    list_of_text: List[str], model="text-embedding-3-small", **kwargs
-) -> List[List[float]]:
-    assert len(list_of_text) <= 2048, "The batch size should not be larger than 2048."
-
-    # replace newlines, which can negatively affect performance.
-    list_of_text = [text.replace("\n", " ") for text in list_of_text]
-
-    data = (
-        await client.embeddings.create(input=list_of_text, model=model, **kwargs)
-    ).data
-    return [d.embedding for d in data]
-
-
-def cosine_similarity(a, b):
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+# Plotting and dimensionality-reduction helpers for exploring embeddings. They pull in matplotlib, plotly
+# and scikit-learn, so they live apart from embeddings_utils, which every pipeline script imports.
 
 
 def plot_multiclass_precision_recall(
@@ -135,30 +84,6 @@ def plot_multiclass_precision_recall(
     plt.legend(lines, labels)
 
 
-def distances_from_embeddings(
-    query_embedding: List[float],
-    embeddings: List[List[float]],
-    distance_metric="cosine",
-) -> List[List]:
-    """Return the distances between a query embedding and a list of embeddings."""
-    distance_metrics = {
-        "cosine": spatial.distance.cosine,
-        "L1": spatial.distance.cityblock,
-        "L2": spatial.distance.euclidean,
-        "Linf": spatial.distance.chebyshev,
-    }
-    distances = [
-        distance_metrics[distance_metric](query_embedding, embedding)
-        for embedding in embeddings
-    ]
-    return distances
-
-
-def indices_of_nearest_neighbors_from_distances(distances) -> np.ndarray:
-    """Return a list of indices of nearest neighbors from a list of distances."""
-    return np.argsort(distances)
-
-
 def pca_components_from_embeddings(
     embeddings: List[List[float]], n_components=2
 ) -> np.ndarray:
@@ -0,0 +1,95 @@
+from typing import List
+
+import numpy as np
+
+from util.api_client import create_embeddings
+
+
+def get_embedding(text: str, model="text-embedding-3-small", **kwargs) -> List[float]:
+    # replace newlines, which can negatively affect performance.
+    text = text.replace("\n", " ")
+
+    response = create_embeddings(input=[text], model=model, **kwargs)
+
+    return response.data[0].embedding
+
+
+def get_embeddings(
+    list_of_text: List[str], model="text-embedding-3-small", **kwargs
+) -> List[List[float]]:
+    assert len(list_of_text) <= 2048, "The batch size should not be larger than 2048."
+
+    # replace newlines, which can negatively affect performance.
+    list_of_text = [text.replace("\n", " ") for text in list_of_text]
+
+    data = create_embeddings(input=list_of_text, model=model, **kwargs).data
+    # the API tags each result with its input position; don't rely on response order.
+    return [d.embedding for d in sorted(data, key=lambda d: d.index)]
+
+
+def cosine_similarity(a, b):
+    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+def normalize_rows(matrix) -> np.ndarray:
+    """
+    Return matrix as float32 with unit-length rows, so a dot product is the cosine similarity.
+    OpenAI embeddings are already unit length, in which case the (possibly memory-mapped) input is returned uncopied.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    # einsum avoids allocating a squared copy of the whole matrix
+    norms = np.sqrt(np.einsum("...i,...i->...", matrix, matrix))[..., None]
+    if np.allclose(norms, 1, atol=1e-3):
+        return matrix
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k_indices(scores, k) -> np.ndarray:
+    """Return the indices of the k highest scores, highest first, without sorting the whole array."""
+    scores = np.asarray(scores)
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    top = np.argpartition(-scores, k)[:k]
+    return top[np.lexsort((top, -scores[top]))]
+
+
+def distances_from_embeddings(
+    query_embedding: List[float],
+    embeddings: List[List[float]],
+    distance_metric="cosine",
+) -> List[List]:
+    """Return the distances between a query embedding and a list of embeddings."""
+    if distance_metric == "cosine":
+        # one matrix-vector product instead of a scipy call per embedding
+        return list(1 - normalize_rows(embeddings) @ normalize_rows(query_embedding))
+
+    from scipy import spatial
+    distance_metrics = {
+        "cosine": spatial.distance.cosine,
+        "L1": spatial.distance.cityblock,
+        "L2": spatial.distance.euclidean,
+        "Linf": spatial.distance.chebyshev,
+    }
+    distances = [
+        distance_metrics[distance_metric](query_embedding, embedding)
+        for embedding in embeddings
+    ]
+    return distances
+
+
+def indices_of_nearest_neighbors_from_distances(distances) -> np.ndarray:
+    """Return a list of indices of nearest neighbors from a list of distances."""
+    return np.argsort(distances)
+
+
+ANALYSIS_FUNCTIONS = {"plot_multiclass_precision_recall", "pca_components_from_embeddings",
+                      "tsne_components_from_embeddings", "chart_from_components", "chart_from_components_3D"}
+
+
+def __getattr__(name):
+    # The plotting helpers moved to embeddings_analysis; it is only imported when one of them is asked for
+    if name in ANALYSIS_FUNCTIONS:
+        from util import embeddings_analysis
+        return getattr(embeddings_analysis, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,34 @@
+import os
+import json
+
+# Extracted lecture text, one JSON line per page or slide: {"source": <file name>, "page": <n>, "text": ...}.
+# combine_documents.py writes <lecture>_text.jsonl and make_learning_objectives.py reads it, so slide and
+# page boundaries survive without rendering and re-parsing a PDF.
+TEXT_SUFFIX = "_text.jsonl"
+
+
+def text_path(folder, lecture):
+    return os.path.join(folder, lecture + TEXT_SUFFIX)
+
+
+def is_lecture_text(path):
+    return str(path).endswith(TEXT_SUFFIX)
+
+
+def lecture_name(path):
+    """The lecture (and tag) name of a <lecture>_text.jsonl or <lecture>.pdf path."""
+    name = os.path.basename(str(path))
+    if name.endswith(TEXT_SUFFIX):
+        return name[:-len(TEXT_SUFFIX)]
+    return os.path.splitext(name)[0]
+
+
+def write_pages(f, source, pages):
+    for page_number, text in enumerate(pages, start=1):
+        f.write(json.dumps({"source": source, "page": page_number, "text": text}, ensure_ascii=False) + "\n")
+
+
+def load_pages(path):
+    """Return the page texts of a lecture text file, in file order."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["text"] for line in f if line.strip()]
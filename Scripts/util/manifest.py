@@ -0,0 +1,80 @@
+import os
+import json
+import hashlib
+from collections import namedtuple
+
+# Content hashes of each lecture's inputs and of every stage's outputs, so an incremental run only
+# re-runs a stage whose inputs changed or whose outputs are missing or were edited since it ran.
+DEFAULT_MANIFEST_PATH = os.path.join("Data", "manifest.json")
+HASH_CHUNK = 1 << 20
+
+# Something other than a file that a stage reads or writes, such as a lecture's rows in the results store,
+# given by name and a hash of its current content; it can stand in the inputs and outputs lists next to paths.
+Digest = namedtuple("Digest", ["name", "value"])
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+
+    def __init__(self, path=DEFAULT_MANIFEST_PATH):
+        self.path = path
+        self.stages = {}
+        self.files = {}  # path -> [size, mtime_ns, sha256], so unchanged files are not re-read
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.stages = data.get("stages", {})
+            self.files = data.get("files", {})
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"stages": self.stages, "files": self.files}, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = self.files.get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hash_file(path)
+        self.files[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def fingerprint(self, paths):
+        """One hash over the names and contents of paths (and Digests); a missing file counts as a change too."""
+        digest = hashlib.sha256()
+        for path in sorted(paths, key=lambda entry: entry.name if isinstance(entry, Digest) else entry):
+            if isinstance(path, Digest):
+                digest.update(path.name.encode())
+                digest.update(path.value.encode())
+                continue
+            digest.update(os.path.basename(path).encode())
+            digest.update((self.file_hash(path) if os.path.isfile(path) else "missing").encode())
+        return digest.hexdigest()
+
+    def is_current(self, lecture, stage, inputs, outputs):
+        """True if stage last ran on these inputs and its outputs are still exactly what it wrote."""
+        record = self.stages.get(lecture, {}).get(stage)
+        return (record is not None and record["inputs"] == self.fingerprint(inputs)
+                and all(isinstance(path, Digest) or os.path.isfile(path) for path in outputs)
+                and record["outputs"] == self.fingerprint(outputs))
+
+    def record(self, lecture, stage, inputs, outputs):
+        self.stages.setdefault(lecture, {})[stage] = {"inputs": self.fingerprint(inputs),
+                                                      "outputs": self.fingerprint(outputs)}
+
+    def update(self, other, lecture):
+        """Take lecture's records and the file hashes from a manifest updated in a worker process."""
+        if lecture in other.stages:
+            self.stages[lecture] = other.stages[lecture]
+        self.files.update(other.files)
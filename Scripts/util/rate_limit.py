@@ -0,0 +1,81 @@
+import time
+import json
+import multiprocessing
+
+from util import telemetry
+
+# Token buckets for the OpenAI requests-per-minute and tokens-per-minute quotas. The bucket state lives in
+# shared memory, so lecture worker processes started with the same limiter draw from one quota.
+REQUESTS_PER_MINUTE = 5000
+TOKENS_PER_MINUTE = 2000000
+CHARS_PER_TOKEN = 4
+
+
+class RateLimiter:
+
+    def __init__(self, rpm=REQUESTS_PER_MINUTE, tpm=TOKENS_PER_MINUTE, context=None):
+        context = context or multiprocessing.get_context()
+        self.rpm = rpm
+        self.tpm = tpm
+        # [requests available, tokens available, time of last refill, no requests before this time]; shared
+        # memory can only reach a child process at start-up, so hand the limiter over through a pool initializer
+        self._state = context.Array("d", [rpm, tpm, time.time(), 0])
+
+    def _refill(self, now):
+        state = self._state
+        elapsed = max(now - state[2], 0)
+        state[0] = min(self.rpm, state[0] + elapsed * self.rpm / 60)
+        state[1] = min(self.tpm, state[1] + elapsed * self.tpm / 60)
+        state[2] = now
+
+    def acquire(self, tokens=0):
+        """Block until one request of about `tokens` tokens fits in both quotas, then take it."""
+        tokens = min(tokens, self.tpm)  # a request bigger than the whole bucket waits for a full one
+        start = time.perf_counter()
+        while True:
+            with self._state.get_lock():
+                now = time.time()
+                self._refill(now)
+                if now >= self._state[3] and self._state[0] >= 1 and self._state[1] >= tokens:
+                    self._state[0] -= 1
+                    self._state[1] -= tokens
+                    break
+                wait = max((1 - self._state[0]) * 60 / self.rpm, (tokens - self._state[1]) * 60 / self.tpm,
+                           self._state[3] - now)
+            time.sleep(min(max(wait, 0.01), 5))
+        telemetry.record_wait(time.perf_counter() - start)
+
+    def pause(self, seconds):
+        """Hold back every request, in every process sharing this limiter, for the next seconds."""
+        with self._state.get_lock():
+            self._state[3] = max(self._state[3], time.time() + seconds)
+
+
+_limiter = None
+
+
+def set_limiter(limiter):
+    """Make every API call in this process go through limiter (None turns limiting off)."""
+    global _limiter
+    _limiter = limiter
+
+
+def get_limiter():
+    return _limiter
+
+
+def estimate_tokens(payload):
+    # rough count for budgeting before the request is sent; the tokenizer is too slow to run here
+    text = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def acquire(tokens=0):
+    if _limiter is not None:
+        _limiter.acquire(tokens)
+
+
+def pause(seconds):
+    # after a 429 the whole quota is exhausted, not just the caller's share
+    if _limiter is not None:
+        _limiter.pause(seconds)
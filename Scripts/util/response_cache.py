@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from util import telemetry
+from util.api_client import create_chat_completion
+
+# Chat completions are cached on disk keyed by a hash of the full request (model, messages, temperature and the
+# other parameters), so a crashed or repeated run only pays for requests it has not made before.
+DEFAULT_CACHE_PATH = os.path.join("Data", "response_cache.sqlite")
+DEFAULT_TTL_DAYS = 180
+DEFAULT_MAX_ENTRIES = 1000000
+EVICT_EVERY = 1000
+
+
+def request_key(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Persistent request hash -> completion text store with TTL and least-recently-used eviction."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl_days=DEFAULT_TTL_DAYS, max_entries=DEFAULT_MAX_ENTRIES):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl_days * 86400
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                           "key TEXT PRIMARY KEY, model TEXT NOT NULL, content TEXT NOT NULL, tokens INTEGER NOT NULL, "
+                           "created REAL NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT content, tokens FROM responses WHERE key = ? AND created >= ?",
+                                     (key, time.time() - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            self.tokens_saved += row[1]
+            return row[0]
+
+    def put(self, key, model, content, tokens=0):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, model, content, tokens, created, last_used) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", (key, model, content, tokens, now, now))
+            self._conn.commit()
+            self._puts += 1
+            evict_now = self._puts % EVICT_EVERY == 0
+        if evict_now:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones past max_entries."""
+        with self._lock:
+            expired = self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)).rowcount
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            excess = max(count - self.max_entries, 0)
+            if excess:
+                self._conn.execute("DELETE FROM responses WHERE rowid IN "
+                                   "(SELECT rowid FROM responses ORDER BY last_used LIMIT ?)", (excess,))
+            self._conn.commit()
+            return expired + excess
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        return (f"Response cache: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate), "
+                f"{self.tokens_saved} tokens not re-sent")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """The shared cache, or None if ANKI_TAGGER_RESPONSE_CACHE is set to 'off'."""
+    global _default_cache
+    path = os.environ.get("ANKI_TAGGER_RESPONSE_CACHE", DEFAULT_CACHE_PATH)
+    if path == "off":
+        return None
+    # the rating and objective thread pools all ask for it at once; they must share one cache and its counters
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache(path)
+    return _default_cache
+
+
+def cached_chat_completion(**params):
+    """Return the message content of openai.chat.completions.create(**params), from the cache when possible."""
+    cache = get_default_cache()
+    key = request_key(params)
+    if cache is not None:
+        content = cache.get(key)
+        if content is not None:
+            telemetry.record_cache_hit("chat")
+            return content
+
+    completion = create_chat_completion(**params)
+    content = completion.choices[0].message.content
+    if cache is not None and content is not None:
+        tokens = completion.usage.total_tokens if completion.usage else 0
+        cache.put(key, params.get("model", ""), content, tokens)
+    return content
@@ -0,0 +1,132 @@
+import os
+import csv
+import sqlite3
+import hashlib
+
+# Every rated (objective, card) pair of every lecture goes into one SQLite store and is committed as it is rated,
+# so no lecture worker holds the write lock while it waits on the API. A crashed or interrupted select_cards run
+# resumes from the card it stopped at: the stored ratings are replayed through the stop rules without being paid for or written twice.
+# tag_deck reads the best score per guid straight from the store, and CSVs are only written when asked for.
+DEFAULT_RESULTS_PATH = os.path.join("Data", "results.sqlite")
+CARD_COLUMNS = ['guid', 'card', 'tag', 'cosine_sim', 'gpt_reply', 'score', 'objective']
+
+
+class ResultsStore:
+
+    def __init__(self, path=DEFAULT_RESULTS_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # lecture workers write here at the same time; WAL lets them, and the timeout waits out each other's commits
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # a commit per rating is cheap in WAL mode without an fsync each; committed rows still survive a crash
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS ratings ("
+                           "lecture TEXT NOT NULL, obj_index INTEGER NOT NULL, objective TEXT NOT NULL, "
+                           "guid TEXT NOT NULL, card TEXT, tag TEXT, cosine_sim REAL, gpt_reply TEXT, score, "
+                           "PRIMARY KEY (lecture, obj_index, guid))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ratings_guid_score ON ratings (guid, score)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS objectives ("
+                           "lecture TEXT NOT NULL, obj_index INTEGER NOT NULL, objective TEXT NOT NULL, stopped TEXT, "
+                           "PRIMARY KEY (lecture, obj_index))")
+        # fingerprint of the inputs a lecture's ratings are made from, written before rating starts
+        self._conn.execute("CREATE TABLE IF NOT EXISTS lectures (lecture TEXT PRIMARY KEY, inputs TEXT)")
+        self._conn.commit()
+
+    def resume(self, lecture, obj_index, objective):
+        """
+        {guid: (gpt_reply, score)} stored for this objective. Ratings stored under an earlier wording of it
+        are dropped, since they would block the new ones from being stored.
+        """
+        self._conn.execute("DELETE FROM ratings WHERE lecture = ? AND obj_index = ? AND objective != ?",
+                           (lecture, obj_index, objective))
+        self.commit()
+        rows = self._conn.execute("SELECT guid, gpt_reply, score FROM ratings "
+                                  "WHERE lecture = ? AND obj_index = ? AND objective = ?",
+                                  (lecture, obj_index, objective)).fetchall()
+        return {guid: (gpt_reply, score) for guid, gpt_reply, score in rows}
+
+    def finished(self, lecture, obj_index, objective):
+        return self._conn.execute("SELECT 1 FROM objectives WHERE lecture = ? AND obj_index = ? AND objective = ?",
+                                  (lecture, obj_index, objective)).fetchone() is not None
+
+    def add(self, lecture, obj_index, guid, card, tag, cosine_sim, gpt_reply, score, objective):
+        # a replayed rating is already here, so OR IGNORE keeps it from being stored twice
+        self._conn.execute("INSERT OR IGNORE INTO ratings (lecture, obj_index, objective, guid, card, tag, cosine_sim, "
+                           "gpt_reply, score) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (lecture, int(obj_index), objective, str(guid), card, tag, float(cosine_sim), gpt_reply, score))
+        self.commit()
+
+    def finish_objective(self, lecture, obj_index, objective, stopped=""):
+        self._conn.execute("INSERT OR REPLACE INTO objectives (lecture, obj_index, objective, stopped) VALUES (?, ?, ?, ?)",
+                           (lecture, int(obj_index), objective, stopped))
+        self.commit()
+
+    def lecture_inputs(self, lecture):
+        row = self._conn.execute("SELECT inputs FROM lectures WHERE lecture = ?", (lecture,)).fetchone()
+        return row[0] if row else None
+
+    def set_lecture_inputs(self, lecture, inputs):
+        self._conn.execute("INSERT OR REPLACE INTO lectures (lecture, inputs) VALUES (?, ?)", (lecture, inputs))
+        self.commit()
+
+    def commit(self):
+        self._conn.commit()
+
+    def _where_lectures(self, lectures):
+        if lectures is None:
+            return "", ()
+        lectures = list(lectures)
+        return f"WHERE lecture IN ({', '.join('?' * len(lectures))})", tuple(lectures)
+
+    def count(self, lectures=None):
+        where, args = self._where_lectures(lectures)
+        return self._conn.execute(f"SELECT COUNT(*) FROM ratings {where}", args).fetchone()[0]
+
+    def best_scores(self, lectures=None):
+        """
+        (guid, tag, score, card) of each guid's highest-scored rating over lectures (default all), what
+        tag_deck tags with. Ties go to the earliest lecture, objective and rating; unparsed ("NA") ratings are left out.
+        """
+        where, args = self._where_lectures(lectures)
+        where = (where + " AND" if where else "WHERE") + " typeof(score) = 'integer'"
+        return self._conn.execute(
+            "SELECT guid, tag, score, card FROM ("
+            "SELECT guid, tag, score, card, ROW_NUMBER() OVER "
+            "(PARTITION BY guid ORDER BY score DESC, lecture, obj_index, rowid) AS rank "
+            f"FROM ratings {where}) WHERE rank = 1 ORDER BY guid", args).fetchall()
+
+    def digest(self, lectures=None):
+        """A hash of the stored ratings and finished objectives, for the incremental-run manifest."""
+        where, args = self._where_lectures(lectures)
+        digest = hashlib.sha256()
+        for query in ("SELECT lecture, obj_index, objective, guid, tag, score FROM ratings {} ORDER BY lecture, obj_index, guid",
+                      "SELECT lecture, obj_index, objective, stopped FROM objectives {} ORDER BY lecture, obj_index"):
+            for row in self._conn.execute(query.format(where), args):
+                digest.update(repr(row).encode())
+        return digest.hexdigest()
+
+    def remove(self, lectures):
+        """Drop every rating and finished objective of lectures, so they are rated afresh next time."""
+        where, args = self._where_lectures(lectures)
+        self._conn.execute(f"DELETE FROM ratings {where}", args)
+        self._conn.execute(f"DELETE FROM objectives {where}", args)
+        self._conn.execute(f"DELETE FROM lectures {where}", args)
+        self.commit()
+
+    def export_csv(self, path, lectures=None):
+        """Write the ratings of lectures (default all) as a <lecture>_cards.csv / Merged.csv, in rating order."""
+        where, args = self._where_lectures(lectures)
+        rows = self._conn.execute("SELECT guid, card, tag, cosine_sim, gpt_reply, score, objective FROM ratings "
+                                  f"{where} ORDER BY lecture, obj_index, rowid", args)
+        with open(path + ".tmp", "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(CARD_COLUMNS)
+            writer.writerows(rows)
+        os.replace(path + ".tmp", path)
+        print(f"Exported ratings to {path}")
+
+    def close(self):
+        self.commit()
+        self._conn.close()
@@ -0,0 +1,267 @@
+import os
+import io
+import json
+import time
+import pstats
+import bisect
+import cProfile
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+# Per-process run metrics: wall time per stage, API call latency histograms (embeddings and chat), retries,
+# rate-limit waits and tokens with an estimated cost. Worker processes hand theirs back with take() and the
+# parent merge()s them; write_report() saves a JSON report and a Prometheus textfile at the end of a run.
+DEFAULT_TELEMETRY_DIR = os.path.join("Data", "telemetry")
+TELEMETRY_DIR_ENV = "ANKI_TAGGER_TELEMETRY_DIR"
+PROFILE_ENV = "ANKI_TAGGER_PROFILE"  # comma-separated stage names (or "all"), so spawned workers profile too
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # seconds, Prometheus-style upper bounds
+PROFILE_LINES = 40
+# USD per million (prompt, completion) tokens; models not listed are reported without a cost
+PRICES_PER_MILLION = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "text-embedding-3-small": (0.02, 0),
+    "text-embedding-3-large": (0.13, 0),
+    "text-embedding-ada-002": (0.10, 0),
+}
+METRIC_PREFIX = "anki_tagger"
+
+_lock = threading.Lock()
+_profiling = threading.Lock()  # cProfile can't nest, so only the outermost profiled stage is captured
+_profile_counts = {}
+
+
+def empty_metrics():
+    return {"stages": {}, "calls": {}, "retries": {}, "tokens": {}, "cache_hits": {}, "rate_limit_wait": 0.0}
+
+
+_metrics = empty_metrics()
+
+
+def telemetry_dir():
+    return os.environ.get(TELEMETRY_DIR_ENV, DEFAULT_TELEMETRY_DIR)
+
+
+def configure(profile=(), folder=None):
+    """Profile the named stages ("all" for every one) and write reports to folder, here and in spawned workers."""
+    os.environ[PROFILE_ENV] = ",".join(profile)
+    if folder:
+        os.environ[TELEMETRY_DIR_ENV] = folder
+
+
+def profiled(name):
+    stages = {s for s in os.environ.get(PROFILE_ENV, "").split(",") if s}
+    return "all" in stages or name in stages
+
+
+@contextmanager
+def stage(name):
+    """Add the wall time of the enclosed block to stage name, under cProfile if that stage is profiled."""
+    profiler = None
+    if profiled(name) and _profiling.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            _profiling.release()
+            save_profile(name, profiler)
+        with _lock:
+            record = _metrics["stages"].setdefault(name, {"seconds": 0.0, "count": 0})
+            record["seconds"] += elapsed
+            record["count"] += 1
+
+
+def save_profile(name, profiler):
+    folder = telemetry_dir()
+    os.makedirs(folder, exist_ok=True)
+    n = _profile_counts[name] = _profile_counts.get(name, 0) + 1
+    path = os.path.join(folder, f"profile_{name}_{os.getpid()}_{n}")
+    profiler.dump_stats(path + ".prof")
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    with open(path + ".txt", "w", encoding="utf-8") as f:
+        f.write(text.getvalue())
+    print(f"Profile of {name} written to {path}.prof (top functions in {path}.txt)")
+
+
+def record_call(kind, seconds, model, prompt_tokens=0, completion_tokens=0):
+    """One API request of kind ("embeddings" or "chat") that took seconds, retries included."""
+    with _lock:
+        calls = _metrics["calls"].setdefault(kind, {"count": 0, "seconds": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)})
+        calls["count"] += 1
+        calls["seconds"] += seconds
+        calls["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        tokens = _metrics["tokens"].setdefault(model, {"prompt": 0, "completion": 0})
+        tokens["prompt"] += prompt_tokens
+        tokens["completion"] += completion_tokens
+
+
+def record_retry(name):
+    """One retried attempt of a request of kind name."""
+    with _lock:
+        _metrics["retries"][name] = _metrics["retries"].get(name, 0) + 1
+
+
+def record_cache_hit(kind):
+    with _lock:
+        _metrics["cache_hits"][kind] = _metrics["cache_hits"].get(kind, 0) + 1
+
+
+def record_wait(seconds):
+    with _lock:
+        _metrics["rate_limit_wait"] += seconds
+
+
+def snapshot():
+    with _lock:
+        return json.loads(json.dumps(_metrics))
+
+
+def take():
+    """Return this process's metrics and start over, for a worker to send its share back to the parent."""
+    global _metrics
+    with _lock:
+        metrics, _metrics = _metrics, empty_metrics()
+    return metrics
+
+
+def merge(other):
+    with _lock:
+        for name, record in other["stages"].items():
+            mine = _metrics["stages"].setdefault(name, {"seconds": 0.0, "count": 0})
+            mine["seconds"] += record["seconds"]
+            mine["count"] += record["count"]
+        for kind, calls in other["calls"].items():
+            mine = _metrics["calls"].setdefault(kind, {"count": 0, "seconds": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)})
+            mine["count"] += calls["count"]
+            mine["seconds"] += calls["seconds"]
+            mine["buckets"] = [a + b for a, b in zip(mine["buckets"], calls["buckets"])]
+        for model, tokens in other["tokens"].items():
+            mine = _metrics["tokens"].setdefault(model, {"prompt": 0, "completion": 0})
+            mine["prompt"] += tokens["prompt"]
+            mine["completion"] += tokens["completion"]
+        for key in ("retries", "cache_hits"):
+            for name, n in other[key].items():
+                _metrics[key][name] = _metrics[key].get(name, 0) + n
+        _metrics["rate_limit_wait"] += other["rate_limit_wait"]
+
+
+def estimated_cost(model, tokens):
+    prices = PRICES_PER_MILLION.get(model)
+    if prices is None:
+        return None
+    return (tokens["prompt"] * prices[0] + tokens["completion"] * prices[1]) / 1e6
+
+
+def bucket_percentile(buckets, p):
+    """Upper bound of the latency bucket holding the p-th percentile call (inf if it's past the last bound)."""
+    target = sum(buckets) * p / 100
+    seen = 0
+    for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+        seen += n
+        if n and seen >= target:
+            return bound
+    return 0.0
+
+
+def build_report(run_name, metrics):
+    calls = {}
+    for kind, record in metrics["calls"].items():
+        calls[kind] = dict(record, mean_seconds=record["seconds"] / max(record["count"], 1),
+                           p50_seconds_le=bucket_percentile(record["buckets"], 50),
+                           p95_seconds_le=bucket_percentile(record["buckets"], 95),
+                           p99_seconds_le=bucket_percentile(record["buckets"], 99))
+    costs = {model: estimated_cost(model, tokens) for model, tokens in metrics["tokens"].items()}
+    return {"run": run_name, "finished": datetime.now().isoformat(timespec="seconds"),
+            "latency_buckets": list(LATENCY_BUCKETS), "stages": metrics["stages"], "calls": calls,
+            "retries": metrics["retries"], "cache_hits": metrics["cache_hits"],
+            "rate_limit_wait_seconds": metrics["rate_limit_wait"], "tokens": metrics["tokens"],
+            "estimated_cost_usd": costs, "total_estimated_cost_usd": sum(c for c in costs.values() if c)}
+
+
+def prometheus_text(report):
+    run = report["run"]
+    lines = [f"# HELP {METRIC_PREFIX}_stage_seconds Wall time of each stage in the last run (summed over lectures).",
+             f"# TYPE {METRIC_PREFIX}_stage_seconds gauge"]
+    for name, record in report["stages"].items():
+        lines.append(f'{METRIC_PREFIX}_stage_seconds{{run="{run}",stage="{name}"}} {record["seconds"]:.3f}')
+
+    lines += [f"# HELP {METRIC_PREFIX}_api_request_duration_seconds OpenAI request latency, retries included.",
+              f"# TYPE {METRIC_PREFIX}_api_request_duration_seconds histogram"]
+    for kind, record in report["calls"].items():
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), record["buckets"]):
+            cumulative += n
+            lines.append(f'{METRIC_PREFIX}_api_request_duration_seconds_bucket{{run="{run}",kind="{kind}",le="{bound}"}} {cumulative}')
+        lines.append(f'{METRIC_PREFIX}_api_request_duration_seconds_sum{{run="{run}",kind="{kind}"}} {record["seconds"]:.3f}')
+        lines.append(f'{METRIC_PREFIX}_api_request_duration_seconds_count{{run="{run}",kind="{kind}"}} {record["count"]}')
+
+    lines += [f"# HELP {METRIC_PREFIX}_api_retries Retried OpenAI requests in the last run.",
+              f"# TYPE {METRIC_PREFIX}_api_retries gauge"]
+    for name, n in report["retries"].items():
+        lines.append(f'{METRIC_PREFIX}_api_retries{{run="{run}",call="{name}"}} {n}')
+
+    lines += [f"# HELP {METRIC_PREFIX}_tokens Tokens sent and received in the last run.",
+              f"# TYPE {METRIC_PREFIX}_tokens gauge"]
+    for model, tokens in report["tokens"].items():
+        for kind in ("prompt", "completion"):
+            lines.append(f'{METRIC_PREFIX}_tokens{{run="{run}",model="{model}",type="{kind}"}} {tokens[kind]}')
+
+    lines += [f"# HELP {METRIC_PREFIX}_estimated_cost_dollars Estimated API cost of the last run.",
+              f"# TYPE {METRIC_PREFIX}_estimated_cost_dollars gauge"]
+    for model, cost in report["estimated_cost_usd"].items():
+        if cost is not None:
+            lines.append(f'{METRIC_PREFIX}_estimated_cost_dollars{{run="{run}",model="{model}"}} {cost:.6f}')
+
+    lines += [f"# TYPE {METRIC_PREFIX}_rate_limit_wait_seconds gauge",
+              f'{METRIC_PREFIX}_rate_limit_wait_seconds{{run="{run}"}} {report["rate_limit_wait_seconds"]:.3f}',
+              f"# TYPE {METRIC_PREFIX}_last_run_timestamp_seconds gauge",
+              f'{METRIC_PREFIX}_last_run_timestamp_seconds{{run="{run}"}} {int(time.time())}']
+    return "\n".join(lines) + "\n"
+
+
+def print_summary(report):
+    for kind, record in report["calls"].items():
+        print(f"{kind}: {record['count']} requests, mean {record['mean_seconds']:.2f}s, "
+              f"p95 <= {record['p95_seconds_le']}s, p99 <= {record['p99_seconds_le']}s")
+    if report["retries"]:
+        print("Retries: " + ", ".join(f"{name} {n}" for name, n in report["retries"].items()))
+    for model, tokens in report["tokens"].items():
+        cost = report["estimated_cost_usd"][model]
+        print(f"{model}: {tokens['prompt']} prompt + {tokens['completion']} completion tokens"
+              + (f", about ${cost:.4f}" if cost is not None else ""))
+
+
+def write_report(run_name, folder=None):
+    """Write <run>_<time>.json and <run>.prom (for node_exporter's textfile collector) and print a summary."""
+    folder = folder or telemetry_dir()
+    os.makedirs(folder, exist_ok=True)
+    report = build_report(run_name, snapshot())
+    json_path = os.path.join(folder, f"{run_name}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    prom_path = os.path.join(folder, f"{run_name}.prom")
+    with open(prom_path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(prometheus_text(report))
+    os.replace(prom_path + ".tmp", prom_path)  # the collector must never read a half-written file
+    print_summary(report)
+    print(f"Telemetry written to {json_path} and {prom_path}")
+    return report
+
+
+@contextmanager
+def run(name, profile=False):
+    """Time a script's whole run as stage name, profile it if asked, and write the report when it ends."""
+    if profile:
+        configure([name])
+    try:
+        with stage(name):
+            yield
+    finally:
+        write_report(name)
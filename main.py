@@ -1,179 +1,406 @@
 import os
 import sys
-import subprocess
+import time
 import shutil
-import pandas as pd
+import argparse
+import traceback
+import multiprocessing
 from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import glob
 
 source_folder = 'Data/'
 file_name = 'anki_deck.apkg'
 script_dir = os.path.dirname(os.path.abspath(__file__))
+emb_path = "Data/anki_embeddings.csv"
 
 source_file = os.path.join(source_folder, file_name)
 destination_file = os.path.join(script_dir, file_name)
-cards_copy_folder = os.path.join(script_dir, 'cards_for_merging')
-
-if not os.path.exists(cards_copy_folder):
-    os.makedirs(cards_copy_folder)
-
-if os.path.exists(source_file):
-    shutil.copyfile(source_file, destination_file)
-    print(f"File {file_name} has been copied from {source_folder} to {script_dir} and overwritten.")
-else:
-    print(f"Source file {source_file} does not exist.")
-
-# Run combine_documents.py
-print("Running combine_documents.py to combine lecture documents into PDFs...")
-combine_command = ["python3", os.path.join(script_dir, "Scripts/combine_documents.py")]
-process = subprocess.run(combine_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-if process.returncode == 0:
-    print("combine_documents.py completed successfully.")
-else:
-    print(f"Error running combine_documents.py: {process.stderr}")
-    sys.exit(1)
-
-def find_pdfs_in_script_folder():
-    pdf_files = glob.glob(os.path.join(script_dir, '*.pdf'))
-    if len(pdf_files) == 0:
-        raise FileNotFoundError(f"No PDF files found in {script_dir}.")
-    return pdf_files
-
-pdf_files = find_pdfs_in_script_folder()
-
-for pdf_file in pdf_files:
-    pdf_name = os.path.splitext(os.path.basename(pdf_file))[0]
-
-    script_file_pairs = [
-        ("Scripts/make_learning_objectives.py", pdf_file),
-        ("Scripts/select_cards.py", "Data/anki_embeddings.csv", f"{pdf_name}_learning_objectives.csv"),
-    ]
+merged_path = os.path.join(script_dir, 'Merged.csv')
 
-    for pair in script_file_pairs:
-        script = pair[0]
-        files = pair[1:]
+# Every stage runs in this process: the scripts are imported once, and the deck embeddings,
+# tokenizer and OpenAI client are loaded once for all lectures. The scripts still work on their own.
+sys.path.insert(0, os.path.join(script_dir, 'Scripts'))
+import combine_documents
+import make_learning_objectives
+import select_cards
+from util.lecture_text import lecture_name, text_path, TEXT_SUFFIX
+from util.embedding_store import matrix_path
+from util.ann_index import index_path
+from util.manifest import Manifest, Digest
+from util.results_store import ResultsStore, DEFAULT_RESULTS_PATH
+from util.rate_limit import RateLimiter, set_limiter, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+from util import telemetry
 
-        # Validate files
-        missing_files = [file for file in files if not os.path.exists(file)]
-        if missing_files:
-            print(f"Skipping {script} due to missing files: {missing_files}")
-            continue
+PROFILE_STAGES = ["combine", "lectures", "objectives", "selection", "export", "tag", "archive", "all"]
+
+stage_times = {}
+lecture_times = {}  # objectives/selection time summed over lectures, which overlap with --workers
+
+
+@contextmanager
+def stage(name, times=stage_times):
+    """Add the wall time of the enclosed block to times[name] (and to the telemetry report)."""
+    start = time.perf_counter()
+    try:
+        with telemetry.stage(name):
+            yield
+    finally:
+        times[name] = times.get(name, 0) + time.perf_counter() - start
+
+
+def report_stage_times(workers=1):
+    total = sum(stage_times.values())
+    print("Wall time per stage:")
+    for name, seconds in stage_times.items():
+        print(f"  {name:<12} {seconds:9.1f}s  {seconds / max(total, 1e-9):6.1%}")
+    print(f"  {'total':<12} {total:9.1f}s")
+    print(f"Within 'lectures', summed over lectures ({workers} at a time):")
+    for name, seconds in lecture_times.items():
+        print(f"  {name:<12} {seconds:9.1f}s")
+
+
+def copy_source_deck():
+    if os.path.exists(source_file):
+        shutil.copyfile(source_file, destination_file)
+        print(f"File {file_name} has been copied from {source_folder} to {script_dir} and overwritten.")
+    else:
+        print(f"Source file {source_file} does not exist.")
+
+
+def find_lectures_in_script_folder():
+    # <lecture>_text.jsonl from combine_documents, plus any PDF placed here directly
+    text_files = glob.glob(os.path.join(script_dir, '*' + TEXT_SUFFIX))
+    names = {lecture_name(path) for path in text_files}
+    pdf_files = [path for path in glob.glob(os.path.join(script_dir, '*.pdf')) if lecture_name(path) not in names]
+    if len(text_files) + len(pdf_files) == 0:
+        raise FileNotFoundError(f"No lecture text or PDF files found in {script_dir}.")
+    return text_files + pdf_files
+
+
+def move_files_to_new_folder(files_to_move, subfolder_path, pdf_name):
+    """
+    Moves specified files and folders to a new subfolder in the archive.
+
+    :param files_to_move: List of files or folders to move.
+    :param subfolder_path: Path to the archive subfolder.
+    :param pdf_name: The base name of the PDF being processed.
+    :return: Path to the new archive folder.
+    """
+    new_folder_name = f"{pdf_name}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+    new_folder_path = os.path.join(subfolder_path, new_folder_name)
+
+    # Ensure the new folder exists
+    os.makedirs(new_folder_path, exist_ok=True)
+
+    for file_path in files_to_move:
+        full_file_path = os.path.abspath(file_path)
+
+        if os.path.isdir(full_file_path):  # Check if the path is a directory
+            shutil.move(full_file_path, os.path.join(new_folder_path, os.path.basename(full_file_path)))
+        elif os.path.isfile(full_file_path):  # Check if the path is a file
+            shutil.move(full_file_path, new_folder_path)
+        else:
+            print(f"Path not found or invalid: {full_file_path}")
+
+    return new_folder_path
+
+
+_worker_deck = None
+
+
+def init_worker(limiter):
+    # runs once in each lecture worker process
+    set_limiter(limiter)
+    select_cards.set_api_key()
+
+
+def objectives_outputs(pdf_name):
+    return [f"{pdf_name}_learning_objectives.csv", f"{pdf_name}_learning_objectives.npy"]
+
+
+def selection_inputs(pdf_name):
+    return objectives_outputs(pdf_name) + [emb_path, matrix_path(emb_path), index_path(emb_path)]
+
+
+def results_digest(lectures):
+    # the lectures' rows in the results store, as a manifest entry
+    store = ResultsStore(DEFAULT_RESULTS_PATH)
+    try:
+        return Digest(f"results:{','.join(sorted(lectures))}", store.digest(lectures))
+    finally:
+        store.close()
 
-        # Ensure the necessary input files exist before running the script
-        for file in files:
-            if not os.path.exists(file):
-                print(f"Required file {file} not found, skipping {script}.")
-                continue
-
-        command = ["python3", "-u", script] + list(files)
-
-        print(f"Running {script} with {files}")
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
-        with process.stdout:
-            for line in iter(process.stdout.readline, ''):
-                print(line, end='', flush=True)
-        with process.stderr:
-            for line in iter(process.stderr.readline, ''):
-                print(line, end='', flush=True)
-        process.wait()
-        #print(f"{script} finished with exit code {process.returncode}\n", flush=True)
-
-    cards_csv = f"{pdf_name}_cards.csv"
-    if os.path.exists(cards_csv):
-        shutil.copy(cards_csv, os.path.join(cards_copy_folder, cards_csv))
-        print(f"Copied {cards_csv} to {cards_copy_folder} for merging.")
-
-    # Move files only after all scripts are successfully run
-    def move_files_to_new_folder(files_to_move, subfolder_path, pdf_name):
-        """
-        Moves specified files and folders to a new subfolder in the archive.
-
-        :param files_to_move: List of files or folders to move.
-        :param subfolder_path: Path to the archive subfolder.
-        :param pdf_name: The base name of the PDF being processed.
-        """
-        new_folder_name = f"{pdf_name}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
-        new_folder_path = os.path.join(subfolder_path, new_folder_name)
-
-        # Ensure the new folder exists
-        os.makedirs(new_folder_path, exist_ok=True)
-        #print(f"Created folder: {new_folder_path}")
-
-        for file_path in files_to_move:
-            full_file_path = os.path.abspath(file_path)
-            #print(f"Processing path: {full_file_path}")
-
-            if os.path.isdir(full_file_path):  # Check if the path is a directory
-                shutil.move(full_file_path, os.path.join(new_folder_path, os.path.basename(full_file_path)))
-                #print(f"Moved folder: {full_file_path} -> {new_folder_path}")
-            elif os.path.isfile(full_file_path):  # Check if the path is a file
-                shutil.move(full_file_path, new_folder_path)
-                #print(f"Moved file: {full_file_path} -> {new_folder_path}")
-            else:
-                print(f"Path not found or invalid: {full_file_path}")
 
-        #print(f"All files and folders moved to {new_folder_path}")
+def remove_stale_selection(pdf_name, inputs):
+    # select_cards resumes from the stored ratings, which is only right while they were made from the same
+    # objectives and deck. The inputs are recorded before rating starts, so a crashed selection still resumes.
+    store = ResultsStore(DEFAULT_RESULTS_PATH)
+    try:
+        if store.lecture_inputs(pdf_name) != inputs:
+            store.remove([pdf_name])
+            if os.path.exists(f"{pdf_name}_spend.csv"):
+                os.remove(f"{pdf_name}_spend.csv")
+            store.set_lecture_inputs(pdf_name, inputs)
+    finally:
+        store.close()
+
 
+def run_lecture(lecture_file, deck=None, manifest=None):
+    """
+    Make objectives and select cards for one lecture. With a manifest, stages whose inputs and outputs
+    are unchanged since they last ran are skipped. Returns the time spent in each stage and the manifest.
+    """
+    global _worker_deck
+    pdf_name = lecture_name(lecture_file)
+    obj_path = f"{pdf_name}_learning_objectives.csv"
+    times = {}
 
+    try:
+        with stage("objectives", times):
+            if manifest and manifest.is_current(pdf_name, "objectives", [lecture_file], objectives_outputs(pdf_name)):
+                print(f"Learning objectives for {pdf_name} are up to date")
+            else:
+                print(f"Making learning objectives for {lecture_file}")
+                make_learning_objectives.main(lecture_file)
+                if manifest:
+                    manifest.record(pdf_name, "objectives", [lecture_file], objectives_outputs(pdf_name))
+
+        with stage("selection", times):
+            if not os.path.exists(obj_path):
+                print(f"Skipping card selection due to missing file: {obj_path}")
+            elif manifest and manifest.is_current(pdf_name, "selection", selection_inputs(pdf_name), [results_digest([pdf_name])]):
+                print(f"Card selection for {pdf_name} is up to date")
+            else:
+                if deck is None:
+                    # the .npy matrix is memory-mapped, so workers share the deck through the page cache instead of copying it
+                    if _worker_deck is None:
+                        _worker_deck = select_cards.load_deck(emb_path)
+                    deck = _worker_deck
+                if manifest:
+                    remove_stale_selection(pdf_name, manifest.fingerprint(selection_inputs(pdf_name)))
+                print(f"Selecting cards for {obj_path}")
+                select_cards.main(emb_path, obj_path, deck=deck)
+                if manifest:
+                    manifest.record(pdf_name, "selection", selection_inputs(pdf_name), [results_digest([pdf_name])])
+    except Exception:
+        print(f"Error processing {lecture_file}:")
+        traceback.print_exc()
+    return times, manifest
+
+
+def run_lecture_in_worker(lecture_file, manifest=None):
+    # the worker's API call and stage metrics go back with its results
+    return run_lecture(lecture_file, manifest=manifest) + (telemetry.take(),)
+
+
+def archive_lecture(lecture_file, store):
+    pdf_name = lecture_name(lecture_file)
+
+    # Move files only after all stages have run
     files_to_move = [
-        f"{pdf_name}_cards.csv",
         f"{pdf_name}_learning_objectives.csv",
-        f"{pdf_name}_progress.csv",
+        f"{pdf_name}_learning_objectives.npy",
+        f"{pdf_name}_spend.csv",
         f"Lectures/{pdf_name}",  # Folder to move
-        pdf_file
+        os.path.join(script_dir, f"{pdf_name}{TEXT_SUFFIX}"),
+        os.path.join(script_dir, f"{pdf_name}.pdf"),
     ]
-    subfolder_path = 'Archive'
-
-    move_files_to_new_folder(files_to_move, subfolder_path, pdf_name)
-
-print(f"All PDFs have been processed.")
-
-# List to hold DataFrames for each CSV file
-dfs = []
-
-# Loop through each file in the cards_copy_folder
-for file_name in os.listdir(cards_copy_folder):
-    if file_name.endswith('.csv'):  # Only process files with the .csv extension
-        file_path = os.path.join(cards_copy_folder, file_name)
-
-        # Read the current CSV file into a DataFrame
-        df = pd.read_csv(file_path)
-
-        # Append the DataFrame to the list
-        dfs.append(df)
-
-# Concatenate all DataFrames into a single DataFrame
-merged_df = pd.concat(dfs, ignore_index=True)
-
-# Save the merged DataFrame to a new CSV file
-output_file_path = os.path.join(script_dir, 'Merged.csv')
-merged_df.to_csv(output_file_path, index=False)
-
-print(f'Merged CSV has been created at: {output_file_path}')
-
-# Run tag_deck.py script on the merged CSV and anki_deck.apkg
-print(f"Running Scripts/tag_deck.py with Merged.csv and anki_deck.apkg")
-
-tag_deck_command = ["python3", "Scripts/tag_deck.py", "Merged.csv", "anki_deck.apkg"]
-process = subprocess.Popen(tag_deck_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
-with process.stdout:
-    for line in iter(process.stdout.readline, ''):
-        print(line, end='', flush=True)
-with process.stderr:
-    for line in iter(process.stderr.readline, ''):
-        print(line, end='', flush=True)
-process.wait()
-
-if process.returncode == 0:
-    print(f"Scripts/tag_deck.py finished successfully.\n")
-else:
-    print(f"Scripts/tag_deck.py encountered an error (exit code: {process.returncode}).\n")
-
-# Cleanup: Delete all {pdf_name}_cards.csv files in cards_copy_folder after merging and tagging
-for file_name in os.listdir(cards_copy_folder):
-    file_path = os.path.join(cards_copy_folder, file_name)
-    if file_name.endswith('_cards.csv'):
-        os.remove(file_path)
-        print(f"Deleted {file_path}")
-
-print("All temporary cards CSV files have been deleted. Process complete.")
+    archive_folder = move_files_to_new_folder(files_to_move, 'Archive', pdf_name)
+
+    # the lecture's ratings move to the archive as its cards CSV, so a later lecture of the same name starts afresh
+    store.export_csv(os.path.join(archive_folder, f"{pdf_name}_cards.csv"), [pdf_name])
+    store.remove([pdf_name])
+
+
+def add_lecture_times(times):
+    for name, seconds in times.items():
+        lecture_times[name] = lecture_times.get(name, 0) + seconds
+
+
+def run_lectures(lecture_files, workers, limiter, manifest=None):
+    if workers <= 1:
+        for lecture_file in lecture_files:
+            times, _ = run_lecture(lecture_file, manifest=manifest)
+            add_lecture_times(times)
+            if manifest:
+                manifest.save()
+        return
+
+    # spawned rather than forked, so no worker inherits the parent's SQLite connections or threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(limiter,)) as pool:
+        futures = {pool.submit(run_lecture_in_worker, lecture_file, manifest): lecture_file for lecture_file in lecture_files}
+        for future in as_completed(futures):
+            times, worker_manifest, worker_telemetry = future.result()
+            add_lecture_times(times)
+            telemetry.merge(worker_telemetry)
+            if manifest:
+                # workers update copies of the manifest; only this process writes it
+                manifest.update(worker_manifest, lecture_name(futures[future]))
+                manifest.save()
+            print(f"Finished {lecture_name(futures[future])}")
+
+
+def combine_changed_lectures(manifest, write_pdf=False):
+    """Extract the text of each Lectures/<lecture> folder whose files changed since the last run."""
+    lectures_folder = os.path.join(script_dir, "Lectures")
+    if not os.path.isdir(lectures_folder):
+        print(f"The 'Lectures' folder does not exist in {script_dir}.")
+        return
+
+    for lecture in sorted(os.listdir(lectures_folder)):
+        folder = os.path.join(lectures_folder, lecture)
+        if not os.path.isdir(folder):
+            continue
+        inputs = combine_documents.source_files(folder)
+        output = text_path(script_dir, lecture)
+        if manifest.is_current(lecture, "combine", inputs, [output]):
+            print(f"Text of {lecture} is up to date")
+            continue
+        print(f"Processing lecture folder: {folder}")
+        combine_documents.combine_texts(folder, output, os.path.join(script_dir, f"{lecture}.pdf") if write_pdf else None)
+        manifest.record(lecture, "combine", inputs, [output])
+    manifest.save()
+
+
+def count_results(lectures):
+    store = ResultsStore(DEFAULT_RESULTS_PATH)
+    try:
+        return store.count(lectures)
+    finally:
+        store.close()
+
+
+def export_merged(lectures):
+    # Merged.csv is no longer needed for tagging; it is only written for --export-csv
+    store = ResultsStore(DEFAULT_RESULTS_PATH)
+    try:
+        store.export_csv(merged_path, lectures)
+    finally:
+        store.close()
+
+
+def tag_results_deck(lectures):
+    print(f"Tagging {destination_file} with the ratings of {len(lectures)} lectures in {DEFAULT_RESULTS_PATH}")
+    try:
+        # anki is only needed for this stage, so it is imported here, where a missing install is reported like any error
+        import tag_deck
+        tag_deck.main(DEFAULT_RESULTS_PATH, destination_file, lectures)
+        print("Tagging finished successfully.\n")
+        return True
+    except Exception:
+        print("Tagging encountered an error:")
+        traceback.print_exc()
+        return False
+
+
+def tag_if_changed(lectures, manifest):
+    inputs = [results_digest(lectures), source_file]
+    if manifest.is_current("deck", "tag", inputs, [destination_file]):
+        print(f"{destination_file} is already tagged with these cards.")
+        return
+    copy_source_deck()
+    if tag_results_deck(lectures):
+        manifest.record("deck", "tag", inputs, [destination_file])
+        manifest.save()
+
+
+def main(workers=1, rpm=REQUESTS_PER_MINUTE, tpm=TOKENS_PER_MINUTE, write_pdf=False, incremental=False,
+         profile=(), telemetry_dir=None, export_csv=False):
+    select_cards.set_api_key()
+    # set before any worker is spawned, so the workers profile and report the same way
+    telemetry.configure(profile, telemetry_dir)
+    # one quota for every lecture, whether they run here or in worker processes
+    limiter = RateLimiter(rpm, tpm, context=multiprocessing.get_context("spawn"))
+    set_limiter(limiter)
+    try:
+        if incremental:
+            run_incremental(workers, limiter, write_pdf, export_csv)
+        else:
+            run_full(workers, limiter, write_pdf, export_csv)
+    finally:
+        report_stage_times(workers)
+        telemetry.write_report("pipeline")
+
+
+def run_full(workers, limiter, write_pdf, export_csv=False):
+    with stage("combine"):
+        print("Extracting lecture documents...")
+        combine_documents.main(write_pdf)
+
+    lecture_files = find_lectures_in_script_folder()
+    lectures = [lecture_name(path) for path in lecture_files]
+
+    with stage("lectures"):
+        run_lectures(lecture_files, workers, limiter)
+
+    print("All lectures have been processed.")
+
+    with stage("export"):
+        if export_csv:
+            export_merged(lectures)
+
+    # tag_deck reads this run's ratings straight from the results store
+    with stage("tag"):
+        if count_results(lectures):
+            copy_source_deck()
+            tag_results_deck(lectures)
+        else:
+            print("No cards to tag.")
+
+    # Archive only once every lecture has finished and been tagged, so no worker's inputs are moved from under it
+    with stage("archive"):
+        store = ResultsStore(DEFAULT_RESULTS_PATH)
+        try:
+            for lecture_file in lecture_files:
+                archive_lecture(lecture_file, store)
+        finally:
+            store.close()
+
+
+def run_incremental(workers, limiter, write_pdf, export_csv=False):
+    # Lectures stay in place instead of being archived, and Data/manifest.json records what each stage last
+    # consumed and produced, so the next run only redoes the stages whose inputs changed.
+    manifest = Manifest()
+
+    with stage("combine"):
+        combine_changed_lectures(manifest, write_pdf)
+
+    lecture_files = find_lectures_in_script_folder()
+    lectures = [lecture_name(path) for path in lecture_files]
+
+    with stage("lectures"):
+        run_lectures(lecture_files, workers, limiter, manifest)
+
+    print("All lectures have been processed.")
+
+    with stage("export"):
+        if export_csv:
+            export_merged(lectures)
+
+    with stage("tag"):
+        if count_results(lectures):
+            tag_if_changed(lectures, manifest)
+        else:
+            print("No cards to tag.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make objectives, select cards and tag the deck for every lecture.")
+    parser.add_argument("--workers", type=int, default=1, help="Lectures processed at once, each in its own process")
+    parser.add_argument("--rpm", type=int, default=REQUESTS_PER_MINUTE, help="OpenAI requests per minute shared by all lectures")
+    parser.add_argument("--tpm", type=int, default=TOKENS_PER_MINUTE, help="OpenAI tokens per minute shared by all lectures")
+    parser.add_argument("--pdf", action="store_true", help="Also render each lecture's combined text to <lecture>.pdf")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Keep lectures in place and only re-run stages whose inputs changed since the last run")
+    parser.add_argument("--profile", nargs="+", choices=PROFILE_STAGES, default=[],
+                        help="Write a cProfile of these stages (all = every stage) to the telemetry folder")
+    parser.add_argument("--telemetry-dir", default=telemetry.DEFAULT_TELEMETRY_DIR,
+                        help="Where the JSON report, Prometheus textfile and profiles are written")
+    parser.add_argument("--export-csv", action="store_true",
+                        help="Also write this run's ratings from the results store to Merged.csv")
+    args = parser.parse_args()
+    main(args.workers, args.rpm, args.tpm, args.pdf, args.incremental, args.profile, args.telemetry_dir, args.export_csv)